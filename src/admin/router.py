@@ -13,12 +13,14 @@ from admin.models import AdminSessionModel, AdminUserModel
 from admin.utils import set_type, process_reviews_tasks_xlsx
 from auth.models import UserModel, UserSessionModel
 from orgs.repository import MembershipRepository
+from payments.repository import PaymentsRepository, BalanceLedgerRepository
 from payments.router import current_prices
+from payments.utils import levels_cache
 from picker.models import PickerServerScheduleModel, PickerSettingsModel, PickerServerContractorModel, \
     PickerHistoryModel, PickerServerModel, PickerOrderStatus, PickerServerClientModel
 
 from gutils import Strings
-from database import Repository, AdminAuditLog
+from database import Repository, AdminAuditLog, async_engine, pool_metrics
 from orders.models import OrdersAddressModel, OrdersOrderModel, OrdersContractorModel, OrdersAccountModel, \
     OrderAddressStatusModel
 from orgs.models import OrganizationModel, OrganizationMembershipModel
@@ -282,6 +284,32 @@ async def reading_data(request: Request, section: str, session: AdminSessionMode
     return [record.__dict__ for record in records]
 
 
+@router.get('/poolMetrics')
+async def pool_metrics_view(session: AdminSessionModel = Depends(authed)):
+    if not 16384 & session.admin.level:
+        raise HTTPException(status_code=403, detail=string_403)
+
+    return {
+        **pool_metrics,
+        'avg_wait_seconds': pool_metrics['wait_seconds'] / pool_metrics['waits'] if pool_metrics['waits'] else 0,
+        'avg_request_checkouts':
+            pool_metrics['request_checkouts'] / pool_metrics['requests'] if pool_metrics['requests'] else 0,
+        'pool': async_engine.pool.status(),
+    }
+
+
+@router.get('/levelsCacheMetrics')
+async def levels_cache_metrics_view(session: AdminSessionModel = Depends(authed)):
+    if not 16384 & session.admin.level:
+        raise HTTPException(status_code=403, detail=string_403)
+
+    return {
+        **levels_cache.metrics,
+        'entries': len(levels_cache.entries),
+        'ttl': levels_cache.ttl,
+    }
+
+
 @router.get('/fields/{section}')
 async def reading_fields(section: str, session: AdminSessionModel = Depends(authed)):
     if not tables_access.get(section, None):
@@ -343,6 +371,15 @@ async def creating_data(data: dict[str, list[dict]], request: Request, session:
 
     await Repository.save_records(models_with_typed_records, session_id=session.id, is_admin=True)
 
+    for model_with_typed_records in models_with_typed_records:
+        if model_with_typed_records['model'] is BalancePricesModel:
+            levels_cache.invalidate()
+
+        elif model_with_typed_records['model'] is OrganizationModel:
+            for record in model_with_typed_records['records']:
+                if 'level_id' in record and record.get('id'):
+                    levels_cache.invalidate(record['id'])
+
 
 @router.delete('/delete/{section}/{record_id}')
 async def reading_fields(section: str, record_id: int, session: AdminSessionModel = Depends(authed)):
@@ -356,6 +393,12 @@ async def reading_fields(section: str, record_id: int, session: AdminSessionMode
 
     await Repository.delete_record(model, record_id)
 
+    if model is BalancePricesModel:
+        levels_cache.invalidate()
+
+    elif model is OrganizationModel:
+        levels_cache.invalidate(record_id)
+
 
 @router.post('/uploadBillMedia')
 async def uploading_bill_media(bill_id: int, file: UploadFile = File(), session: AdminSessionModel = Depends(authed)):
@@ -372,9 +415,10 @@ async def uploading_bill_media(bill_id: int, file: UploadFile = File(), session:
 
     bill = bills[0]
 
-    content = await file.read()
-    n, t = await Repository.s3_autosave(content,
-                                        f"{Strings.alphanumeric(32)}.{file.filename.rsplit('.', maxsplit=1)[1]}")
+    try:
+        n, t = await Repository.s3_autosave_upload(file, file.filename)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"{file.filename}: {str(e)}")
 
     record = {'id': bill.id, 'media': f'{n}.{t}'}
 
@@ -667,26 +711,12 @@ async def create_organization(org_id: int = None, session: AdminSessionModel = D
     if not 2048 & session.admin.level:
         raise HTTPException(status_code=403, detail=string_403)
 
-    query = 'SELECT SUM(' \
-            'CASE ' \
-            'WHEN action_id IN (1, 4) THEN amount ' \
-            'WHEN action_id IN (2, 3) THEN -amount ' \
-            'ELSE 0 ' \
-            'END) AS total_amount ' \
-            'FROM balance_history '
-
     if org_id is not None:
+        return await PaymentsRepository.get_org_balance(org_id)
 
-        try:
-            int(org_id)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=string_400)
+    balances = await PaymentsRepository.get_balances()
 
-        query += f'WHERE org_id = {org_id};'
-
-    result = await Repository.execute_sql(query)
-
-    return result[0][0]
+    return sum(balances.values())
 
 
 @router.get('/getBalances')
@@ -694,19 +724,15 @@ async def create_organization(session: AdminSessionModel = Depends(authed)):
     if not 2048 & session.admin.level:
         raise HTTPException(status_code=403, detail=string_403)
 
-    query = 'SELECT org_id,' \
-            'SUM(' \
-            'CASE ' \
-            'WHEN action_id IN (1, 4) THEN amount ' \
-            'WHEN action_id IN (2, 3) THEN -amount ' \
-            'ELSE 0 ' \
-            'END) AS balance ' \
-            'FROM balance_history ' \
-            'GROUP BY org_id;'
+    return await PaymentsRepository.get_balances()
+
 
-    result = await Repository.execute_sql(query)
+@router.post('/reconcileBalances')
+async def reconcile_balances(fix: bool = False, session: AdminSessionModel = Depends(authed)):
+    if not 2048 & session.admin.level:
+        raise HTTPException(status_code=403, detail=string_403)
 
-    return {x[0]: x[1] for x in result}
+    return await BalanceLedgerRepository.reconcile(fix)
 
 
 # Forced saves
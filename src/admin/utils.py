@@ -1,12 +1,9 @@
 import datetime
-from io import BytesIO
-
-import pandas as pd
 
 from database import Repository
 from payments.models import BalanceHistoryModel
 from payments.router import current_prices
-from picker.utils import parse_excel_lines
+from picker.utils import read_upload_lines
 from products.models import ReviewModel,  ProductModel
 
 
@@ -44,9 +41,7 @@ async def process_reviews_tasks_xlsx(file):
         'review_id': 13,
     }
 
-    xlsx_reviews_content = await file.read()
-    xlsx_reviews = await parse_excel_lines(pd.read_excel(BytesIO(xlsx_reviews_content), dtype=str).values.tolist(),
-                                           excel_columns)
+    xlsx_reviews = await read_upload_lines(file, excel_columns, False)
 
     # xlsx check
     for line in xlsx_reviews:
@@ -91,9 +86,8 @@ async def process_reviews_tasks_xlsx(file):
     # process reviews
     organizations_prices = {}
     for review in reviews_to_process:
-        if not organizations_prices.get(review[0].product.organization.id):
-            level, purchases = await current_prices(review[0].product.organization)
-            organizations_prices[review[0].product.organization.id] = level
+        level, purchases = await current_prices(review[0].product.organization)
+        organizations_prices[review[0].product.organization.id] = level
 
     review_records = []
     balance_records = []
@@ -162,17 +162,17 @@ async def register(data: Annotated[UserUpdateSchema, Depends()],
     record = {**data.model_dump(), 'id': session.user.id}
 
     if file:
-        href = Strings.alphanumeric(32)
-        record['media'] = href + '.webp'
+        try:
+            n, t = await Repository.s3_autosave_upload(file, file.filename)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"{file.filename}: {str(e)}")
+
+        record['media'] = f'{n}.{t}'
 
     await Repository.save_records([
         {'model': UserModel, 'records': [record]}
     ])
 
-    if file:
-        content = await file.read()
-        await Repository.s3_save_image(content, f"{href}.{file.filename.rsplit('.', maxsplit=1)[1]}")
-
 
 @router.post('/updatePassword')
 async def update_password(opw: str, npw: str, session: UserSessionModel = Depends(authed)):
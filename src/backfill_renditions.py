@@ -0,0 +1,37 @@
+import asyncio
+
+import main  # registers every model for mapper configuration
+from auth.models import UserModel
+from config import IMAGE_RENDITIONS, IMAGE_PROCESS_WORKERS
+from database import Repository
+from products.models import ProductModel, ReviewMediaModel
+
+
+# usage: python -m backfill_renditions
+async def backfill():
+    file_names = set()
+
+    for model in [ProductModel, ReviewMediaModel, UserModel]:
+        for record in await Repository.get_records(model, filters=[model.media.isnot(None)]):
+            if record.media.endswith('.webp'):
+                file_names.add(record.media)
+
+    semaphore = asyncio.Semaphore(IMAGE_PROCESS_WORKERS * 2)
+    failed = []
+
+    async def backfill_file(file_name):
+        async with semaphore:
+            try:
+                await Repository.s3_save_renditions(file_name, list(IMAGE_RENDITIONS))
+            except Exception as e:
+                failed.append((file_name, str(e)))
+
+    await asyncio.gather(*[backfill_file(file_name) for file_name in file_names])
+
+    print(f'{len(file_names) - len(failed)}/{len(file_names)} images')
+    for file_name, error in failed:
+        print(f'{file_name}: {error}')
+
+
+if __name__ == '__main__':
+    asyncio.run(backfill())
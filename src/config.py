@@ -13,6 +13,24 @@ HASHSALT = os.environ.get('HASHSALT')
 S3KID = os.environ.get('S3KID')
 S3KEY = os.environ.get('S3KEY')
 S3BUCKET = os.environ.get('S3BUCKET')
+S3ENDPOINT = os.environ.get('S3ENDPOINT', 'https://storage.yandexcloud.net')
+S3_WORKERS = int(os.environ.get('S3_WORKERS', 8))
+S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD', 1048576 * 8))
+S3_MULTIPART_CHUNKSIZE = int(os.environ.get('S3_MULTIPART_CHUNKSIZE', 1048576 * 8))
+S3_KNOWN_OBJECTS = int(os.environ.get('S3_KNOWN_OBJECTS', 100000))
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 100))
+DB_COPY_THRESHOLD = int(os.environ.get('DB_COPY_THRESHOLD', 100))
+
+LEVELS_CACHE_TTL = int(os.environ.get('LEVELS_CACHE_TTL', 300))
+
+PICKER_JOB_WORKERS = int(os.environ.get('PICKER_JOB_WORKERS', 1))
+PICKER_JOB_HEARTBEAT = int(os.environ.get('PICKER_JOB_HEARTBEAT', 30))
+PICKER_PROCESS_WORKERS = int(os.environ.get('PICKER_PROCESS_WORKERS', 2))
 
 ACCEPTABLE_IMAGE_TYPES = {
     'jpeg': 1048576 * 10,
@@ -30,3 +48,13 @@ ACCEPTABLE_FILE_TYPES = {
 }
 
 DEFAULT_MAX_FILE_SIZE = 1048576 * 25
+
+IMAGE_MAX_WIDTH = int(os.environ.get('IMAGE_MAX_WIDTH', 2048))
+IMAGE_MAX_HEIGHT = int(os.environ.get('IMAGE_MAX_HEIGHT', 2048))
+IMAGE_WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', 80))
+IMAGE_PROCESS_WORKERS = int(os.environ.get('IMAGE_PROCESS_WORKERS', 2))
+
+# {rendition: max size}, stored next to the image as <name>_<rendition>.webp
+IMAGE_RENDITIONS = {
+    'thumb': (160, 160),
+}
@@ -1,36 +1,260 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
 import datetime
+import functools
+import hashlib
+import importlib
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from typing import Annotated
 
 import boto3
-from PIL import Image
-from sqlalchemy import update, select, delete, Column, JSON, text
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from sqlalchemy import update, select, delete, insert, Column, JSON, text, event
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncSession
-from sqlalchemy.orm import DeclarativeBase, selectinload, joinedload, Mapped, mapped_column
+from sqlalchemy.orm import DeclarativeBase, selectinload, joinedload, Mapped, mapped_column, Session
 
+from gutils import Images
 from strings import *
 from config import (
     DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER,
-    S3KID, S3KEY, S3BUCKET,
-    ACCEPTABLE_IMAGE_TYPES, ACCEPTABLE_FILE_TYPES, DEFAULT_MAX_FILE_SIZE
+    S3KID, S3KEY, S3BUCKET, S3ENDPOINT, S3_WORKERS, S3_MULTIPART_THRESHOLD, S3_MULTIPART_CHUNKSIZE,
+    S3_KNOWN_OBJECTS,
+    ACCEPTABLE_IMAGE_TYPES, ACCEPTABLE_FILE_TYPES, DEFAULT_MAX_FILE_SIZE,
+    IMAGE_MAX_WIDTH, IMAGE_MAX_HEIGHT, IMAGE_WEBP_QUALITY, IMAGE_PROCESS_WORKERS, IMAGE_RENDITIONS,
+    DB_COPY_THRESHOLD, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_PRE_PING, DB_POOL_RECYCLE, DB_STATEMENT_CACHE_SIZE
 )
 
 # PostgreSQL
-async_engine = create_async_engine(url=f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+pool_metrics = {
+    'checkouts': 0,
+    'waits': 0,
+    'wait_seconds': 0.0,
+    'max_wait_seconds': 0.0,
+    'requests': 0,
+    'request_checkouts': 0,
+    'max_request_checkouts': 0,
+}
+
+# {'session': AsyncSession, 'checkouts': int} of the API request being handled
+request_context = contextvars.ContextVar('request_context', default=None)
+
+
+async_engine = create_async_engine(
+    url=f'postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}',
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    pool_recycle=DB_POOL_RECYCLE,
+    connect_args={'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE},
+)
 async_session_factory = async_sessionmaker(async_engine)
 
+
+@event.listens_for(async_engine.sync_engine, 'checkout')
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics['checkouts'] += 1
+
+    context = request_context.get()
+    if context is not None:
+        context['checkouts'] += 1
+
+
+# a session checks out a connection when its first statement runs, the wait is the time until the transaction begins
+@event.listens_for(Session, 'do_orm_execute')
+def start_checkout_wait(orm_execute_state):
+    if not orm_execute_state.session.in_transaction():
+        orm_execute_state.session.info['checkout_started'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_begin')
+def measure_checkout_wait(session, transaction, connection):
+    started = session.info.pop('checkout_started', None)
+
+    if started is not None:
+        wait = time.perf_counter() - started
+        pool_metrics['waits'] += 1
+        pool_metrics['wait_seconds'] += wait
+        pool_metrics['max_wait_seconds'] = max(pool_metrics['max_wait_seconds'], wait)
+
+
+async def request_session_scope():
+    # unit of work of an API request, repository calls made while handling it share one session and connection
+    context = {'session': async_session_factory(), 'checkouts': 0}
+    request_context.set(context)
+
+    try:
+        yield context['session']
+
+    finally:
+        await context['session'].close()
+
+        pool_metrics['requests'] += 1
+        pool_metrics['request_checkouts'] += context['checkouts']
+        pool_metrics['max_request_checkouts'] = max(pool_metrics['max_request_checkouts'], context['checkouts'])
+
+
+@contextlib.asynccontextmanager
+async def session_scope():
+    context = request_context.get()
+
+    if context is None:
+        async with async_session_factory() as session:
+            yield session
+        return
+
+    session = context['session']
+
+    try:
+        yield session
+
+    except Exception:
+        await session.rollback()
+        raise
+
+    finally:
+        # returned objects are detached as if the session had been closed
+        session.expunge_all()
+
+
+async def release_request_connection():
+    # the request session keeps its connection until the transaction ends, it is ended before slow external calls
+    # and the next query checks out a connection again
+    context = request_context.get()
+
+    if context is not None and context['session'].in_transaction():
+        await context['session'].commit()
+
+
 # S3 Object Storage
 s3 = boto3.session.Session().client(
     service_name='s3',
-    endpoint_url='https://storage.yandexcloud.net',
+    endpoint_url=S3ENDPOINT,
     aws_access_key_id=S3KID,
     aws_secret_access_key=S3KEY
 )
 
+# boto3 is blocking, calls run in a bounded thread pool, parts of large files are uploaded concurrently
+s3_pool = ThreadPoolExecutor(max_workers=S3_WORKERS, thread_name_prefix='s3')
+s3_transfer = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+)
+
+
+async def s3_call(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(s3_pool, functools.partial(func, *args, **kwargs))
+
+
+# media keys are content hashes, keys known to exist in storage skip the upload, least recently seen are dropped
+known_objects = collections.OrderedDict()
+
+
+def remember_object(key):
+    known_objects[key] = None
+    known_objects.move_to_end(key)
+
+    if len(known_objects) > S3_KNOWN_OBJECTS:
+        known_objects.popitem(last=False)
+
+
+async def s3_exists(key):
+    if key in known_objects:
+        known_objects.move_to_end(key)
+        return True
+
+    try:
+        await s3_call(s3.head_object, Bucket=S3BUCKET, Key=key)
+    except ClientError as e:
+        # only a missing object is uploaded, denied access or throttling are raised instead of overwriting
+        if e.response.get('Error', {}).get('Code') in ['404', 'NoSuchKey', 'NotFound']:
+            return False
+        raise
+
+    remember_object(key)
+    return True
+
+
+def content_name(digest):
+    return digest.hexdigest()[:32]
+
+
+# images are decoded and encoded in worker processes, the semaphore bounds queued uploads held in memory
+image_pool = None
+image_semaphore = asyncio.Semaphore(IMAGE_PROCESS_WORKERS)
+
+
+async def image_to_webp(file_bytes, sizes: dict):
+    global image_pool
+
+    if image_pool is None:
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+
+    async with image_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            image_pool,
+            functools.partial(Images.to_webp, file_bytes, sizes, IMAGE_WEBP_QUALITY)
+        )
+
+
+def rendition_name(file_name, rendition):
+    return f'{file_name}_{rendition}.webp' if rendition else f'{file_name}.webp'
+
+
+class SizeLimitedReader:
+    def __init__(self, file, limit):
+        self.file = file
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        self.size += len(chunk)
+
+        if self.size > self.limit:
+            raise Exception(string_storage_max_size)
+
+        return chunk
+
+
+def file_content_name(reader):
+    digest = hashlib.sha256()
+
+    while chunk := reader.read(S3_MULTIPART_CHUNKSIZE):
+        digest.update(chunk)
+
+    return content_name(digest)
+
+
 pk = Annotated[int, mapped_column(primary_key=True)]
 dt = Annotated[datetime.datetime, mapped_column(server_default=text('NOW()'))]
 
 models_to_logs = ['OrdersOrderModel', 'ReviewModel', 'ProductSizeModel', 'ProductModel']
+models_to_copy = ['BalanceHistoryModel', 'OrdersOrderModel', 'ReviewModel']
+
+# {model name: ledger}, a ledger keeps derived rows in the transaction that writes the model or a parent whose
+# updates and deletes cascade into it. add(session, model, records) follows inserts,
+# orgs_of(session, model, ids) and rebuild(session, orgs) surround updates and deletes.
+# ledger modules import this one, so they are imported on first use
+ledgers = {
+    'BalanceHistoryModel': 'payments.repository.BalanceLedgerRepository',
+    'BalanceActionModel': 'payments.repository.BalanceLedgerRepository',
+    'BalanceTargetModel': 'payments.repository.BalanceLedgerRepository',
+}
+
+
+def ledger_of(model):
+    if model.__name__ not in ledgers:
+        return None
+
+    module_name, ledger_name = ledgers[model.__name__].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), ledger_name)
 
 
 class Base(DeclarativeBase):
@@ -74,45 +298,127 @@ class Repository:
         if file_type not in acceptable_types:
             raise Exception(string_storage_wrong_filetype + f'. Только: {acceptable_types}')
 
-        if file_type in {**ACCEPTABLE_FILE_TYPES, **ACCEPTABLE_IMAGE_TYPES}.keys():
-            if file.size > {**ACCEPTABLE_FILE_TYPES, **ACCEPTABLE_IMAGE_TYPES}[file_type]:
-                raise Exception(string_storage_max_size)
-        else:
-            if file.size > DEFAULT_MAX_FILE_SIZE:
-                raise Exception(string_storage_max_size)
+        if file.size > cls.max_file_size(file_type):
+            raise Exception(string_storage_max_size)
 
         return file_name, file_type
 
+    @classmethod
+    def max_file_size(cls, file_type):
+        return {**ACCEPTABLE_FILE_TYPES, **ACCEPTABLE_IMAGE_TYPES}.get(file_type, DEFAULT_MAX_FILE_SIZE)
+
     @classmethod
     async def s3_autosave(cls, file_bytes, file_full_name):
+        await release_request_connection()
 
-        file_info = file_full_name.rsplit('.', maxsplit=1)
-        file_name = file_info[0]
-        file_type = file_info[1].lower()
+        file_type = file_full_name.rsplit('.', maxsplit=1)[1].lower()
 
         if file_type in ACCEPTABLE_IMAGE_TYPES.keys():
-            await cls.s3_save_image(file_bytes, file_full_name)
-            return file_name, 'webp'
+            return await cls.s3_save_image(file_bytes), 'webp'
         else:
-            await cls.s3_save(file_bytes, file_full_name)
-            return file_name, file_type
+            return await cls.s3_save(file_bytes, file_type), file_type
 
     @classmethod
-    async def s3_save_image(cls, file_bytes, file_full_name):
-        file_info = file_full_name.rsplit('.', maxsplit=1)
-        file_name = file_info[0]
+    async def s3_autosave_upload(cls, file, file_full_name):
+        await release_request_connection()
+
+        file_type = file_full_name.rsplit('.', maxsplit=1)[1].lower()
+        limit = cls.max_file_size(file_type)
+
+        # images are bounded by their limit and decoded whole
+        if file_type in ACCEPTABLE_IMAGE_TYPES.keys():
+            file.file.seek(0)
+            return await cls.s3_save_image(await s3_call(SizeLimitedReader(file.file, limit).read, limit + 1)), 'webp'
+
+        # other files are hashed from the spooled file, then go to storage in chunks
+        file.file.seek(0)
+        file_name = await s3_call(file_content_name, SizeLimitedReader(file.file, limit))
+
+        if not await s3_exists(f'{file_name}.{file_type}'):
+            file.file.seek(0)
+            await s3_call(s3.upload_fileobj, file.file, S3BUCKET, f'{file_name}.{file_type}', Config=s3_transfer)
+            remember_object(f'{file_name}.{file_type}')
+
+        return file_name, file_type
+
+    @classmethod
+    async def s3_autosave_uploads(cls, files: list[tuple]):
+        await release_request_connection()
+
+        return await asyncio.gather(*[cls.s3_autosave_upload(file, file_full_name) for file, file_full_name in files])
+
+    @classmethod
+    async def s3_save_image(cls, file_bytes):
+        await release_request_connection()
+
+        file_name = content_name(hashlib.sha256(file_bytes))
+
+        if await s3_exists(rendition_name(file_name, None)):
+            return file_name
+
+        encoded = await image_to_webp(file_bytes, {None: (IMAGE_MAX_WIDTH, IMAGE_MAX_HEIGHT), **IMAGE_RENDITIONS})
+
+        # full size goes last, its presence means the renditions are stored as well
+        await asyncio.gather(*[
+            s3_call(s3.upload_fileobj, io.BytesIO(content), S3BUCKET, rendition_name(file_name, rendition),
+                    Config=s3_transfer)
+            for rendition, content in encoded.items() if rendition
+        ])
+        await s3_call(s3.upload_fileobj, io.BytesIO(encoded[None]), S3BUCKET, rendition_name(file_name, None),
+                      Config=s3_transfer)
+
+        for rendition in encoded:
+            remember_object(rendition_name(file_name, rendition))
+
+        return file_name
+
+    @classmethod
+    async def s3_save_renditions(cls, file_full_name, renditions: list):
+        await release_request_connection()
+
+        file_name = file_full_name.rsplit('.', maxsplit=1)[0]
+
+        missing = []
+        for rendition in renditions:
+            if not await s3_exists(rendition_name(file_name, rendition)):
+                missing.append(rendition)
+
+        if not missing:
+            return
+
+        encoded = await image_to_webp(
+            await cls.s3_read(file_full_name),
+            {rendition: IMAGE_RENDITIONS[rendition] for rendition in missing}
+        )
+
+        await asyncio.gather(*[
+            s3_call(s3.upload_fileobj, io.BytesIO(content), S3BUCKET, rendition_name(file_name, rendition),
+                    Config=s3_transfer)
+            for rendition, content in encoded.items()
+        ])
 
-        image = Image.open(io.BytesIO(file_bytes))
-        image.save(io.BytesIO(), format='WEBP', optimize=True, quality=15)
+        for rendition in missing:
+            remember_object(rendition_name(file_name, rendition))
 
-        webp_bytes = io.BytesIO()
-        image.save(webp_bytes, format='WebP')
-        file_content = webp_bytes.getvalue()
-        s3.upload_fileobj(io.BytesIO(file_content), S3BUCKET, f'{file_name}.webp')
+    @classmethod
+    async def s3_save(cls, file_bytes, file_type):
+        file_name = content_name(hashlib.sha256(file_bytes))
+
+        if not await s3_exists(f'{file_name}.{file_type}'):
+            await s3_call(s3.upload_fileobj, io.BytesIO(file_bytes), S3BUCKET, f'{file_name}.{file_type}',
+                          Config=s3_transfer)
+            remember_object(f'{file_name}.{file_type}')
+
+        return file_name
+
+    @classmethod
+    async def s3_save_file(cls, file_path, file_full_name):
+        await s3_call(s3.upload_file, file_path, S3BUCKET, file_full_name, Config=s3_transfer)
 
     @classmethod
-    async def s3_save(cls, file_bytes, file_full_name):
-        s3.upload_fileobj(io.BytesIO(file_bytes), S3BUCKET, file_full_name)
+    async def s3_read(cls, file_full_name):
+        response = await s3_call(s3.get_object, Bucket=S3BUCKET, Key=file_full_name)
+        return await s3_call(response['Body'].read)
 
     @classmethod
     async def save_records(cls, models, session_id=None, is_admin=False):
@@ -144,42 +450,86 @@ class Repository:
             return data
 
         try:
-            async with async_session_factory() as session:
+            async with session_scope() as session:
 
-                records_to_insert = []
                 audit_log_records = []
 
                 for model in models:
-                    is_logging = model['model'].__name__ in models_to_logs
+                    is_logging = session_id and model['model'].__name__ in models_to_logs
+                    ledger = ledger_of(model['model'])
+
+                    # several updates of one id are applied in order, as consecutive merges would do
+                    records_to_update = {}
+                    records_to_insert = []
 
                     for record in model['records']:
                         if record.get('id'):
-
-                            if session_id and is_logging:
-                                old_data_model = await session.get(model['model'], record['id'])
-                                old_data_dict = await to_dict(old_data_model)
-
-                            new_data_model = await session.merge(model['model'](**record))
-
-                            if session_id and is_logging:
-                                new_data_dict = await to_dict(new_data_model)
-
-                                audit_log_records.append(
-                                    AdminAuditLog(
-                                        session_id=session_id,
-                                        is_admin=is_admin,
-                                        table=model['model'].__tablename__,
-                                        record_id=record['id'],
-                                        action=2,
-                                        old_data=old_data_dict,
-                                        new_data=new_data_dict,
-                                    )
+                            records_to_update.setdefault(record['id'], {}).update(record)
+                        else:
+                            records_to_insert.append({key: value for key, value in record.items() if key != 'id'})
+
+                    old_data_dicts = {}
+                    if records_to_update and is_logging:
+                        old_data_models = await session.scalars(
+                            select(model['model']).where(model['model'].id.in_(list(records_to_update)))
+                        )
+
+                        for old_data_model in old_data_models:
+                            old_data_dicts[old_data_model.id] = await to_dict(old_data_model)
+
+                        existing_ids = set(old_data_dicts)
+
+                    elif records_to_update:
+                        existing_ids = set(await session.scalars(
+                            select(model['model'].id).where(model['model'].id.in_(list(records_to_update)))
+                        ))
+
+                    # ids that are not in the table yet are inserted with their id, as merge does
+                    for record_id in list(records_to_update):
+                        if record_id not in existing_ids:
+                            records_to_insert.append(records_to_update.pop(record_id))
+
+                    # bulk UPDATE by primary key, sent as executemany batches grouped by the updated columns
+                    records_with_values = [record for record in records_to_update.values() if len(record) > 1]
+                    if records_with_values:
+                        if ledger:
+                            ledger_orgs = await ledger.orgs_of(session, model['model'], list(records_to_update))
+
+                        await session.execute(update(model['model']), records_with_values)
+
+                        if ledger:
+                            ledger_orgs |= await ledger.orgs_of(session, model['model'], list(records_to_update))
+                            await ledger.rebuild(session, ledger_orgs)
+
+                    # bulk UPDATE by primary key does not support RETURNING, new values are read back
+                    if records_to_update and is_logging:
+                        new_data_models = await session.scalars(
+                            select(model['model'])
+                            .where(model['model'].id.in_(list(records_to_update)))
+                            .execution_options(populate_existing=True)
+                        )
+
+                        for new_data_model in new_data_models.all():
+                            audit_log_records.append(
+                                AdminAuditLog(
+                                    session_id=session_id,
+                                    is_admin=is_admin,
+                                    table=model['model'].__tablename__,
+                                    record_id=new_data_model.id,
+                                    action=2,
+                                    old_data=old_data_dicts[new_data_model.id],
+                                    new_data=await to_dict(new_data_model),
                                 )
+                            )
 
-                        else:
-                            records_to_insert.append(model['model'](**record))
+                    if len(records_to_insert) >= DB_COPY_THRESHOLD and model['model'].__name__ in models_to_copy:
+                        await cls.copy_records(model['model'], records_to_insert, session)
+
+                    elif records_to_insert:
+                        await session.execute(insert(model['model']), records_to_insert)
 
-                session.add_all(records_to_insert)
+                        if ledger:
+                            await ledger.add(session, model['model'], records_to_insert)
 
                 if audit_log_records:
                     session.add_all(audit_log_records)
@@ -191,27 +541,78 @@ class Repository:
             await session.rollback()
             raise e
 
-        finally:
-            await session.close()
+    @classmethod
+    async def copy_records(cls, model, records, session=None):
+        """
+        COPY of new records into an append-only table, no ORM objects are built
+        :param model: Base
+        :param records: [{}]
+        :param session: AsyncSession, the copy and the ledger update join its transaction
+        :return: None
+        """
+
+        if session is None:
+            async with session_scope() as session:
+                await cls.copy_records(model, records, session)
+                await session.commit()
+            return
+
+        # python side defaults are not applied by COPY, server side ones are applied to omitted columns
+        defaults = {
+            column.key: column.default.arg
+            for column in model.__table__.columns
+            if column.default is not None and column.default.is_scalar
+        }
+
+        records_by_keys = {}
+        for record in records:
+            record = {**defaults, **record}
+            records_by_keys.setdefault(tuple(record), []).append(tuple(record.values()))
+
+        # the driver transaction begins with the first statement, so a leading copy
+        # would otherwise run in a transaction of its own and commit apart from the session
+        connection = await session.connection()
+        await connection.exec_driver_sql('SELECT 1')
+
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+
+        # savepoint inside the session transaction
+        async with driver_connection.transaction():
+            for keys, values in records_by_keys.items():
+                await driver_connection.copy_records_to_table(
+                    model.__tablename__,
+                    records=values,
+                    columns=list(keys),
+                )
+
+        ledger = ledger_of(model)
+        if ledger:
+            await ledger.add(session, model, records)
 
     @classmethod
     async def update_records(cls, model, records):
-        try:
-            async with async_session_factory() as session:
-                for record in records:
-                    query = update(model).where(model.id == record['id']).values(**record)
-                    await session.execute(query)
+        async with session_scope() as session:
+            ledger = ledger_of(model)
+            record_ids = [record['id'] for record in records]
+            ledger_orgs = await ledger.orgs_of(session, model, record_ids) if ledger else None
 
-                await session.commit()
-        finally:
-            await session.close()
+            for record in records:
+                query = update(model).where(model.id == record['id']).values(**record)
+                await session.execute(query)
+
+            if ledger:
+                ledger_orgs |= await ledger.orgs_of(session, model, record_ids)
+                await ledger.rebuild(session, ledger_orgs)
+
+            await session.commit()
 
     @classmethod
     async def get_records(cls, model, filters=None, joins=None, select_related=None, prefetch_related=None,
                           order_by=None, limit=None, offset=None, selects=None, deep_related=None, filtration=None):
 
         try:
-            async with async_session_factory() as session:
+            async with session_scope() as session:
 
                 if selects:
                     query = select(model, *selects)
@@ -261,32 +662,27 @@ class Repository:
             await session.rollback()
             raise e
 
-        finally:
-            await session.close()
-
     @classmethod
     async def delete_record(cls, model, record_id: int):
 
-        try:
-            async with async_session_factory() as session:
+        async with session_scope() as session:
+            ledger = ledger_of(model)
+            ledger_orgs = await ledger.orgs_of(session, model, [record_id]) if ledger else None
 
-                query = (
-                    delete(model)
-                    .where(model.id == record_id)
-                )
+            query = (
+                delete(model)
+                .where(model.id == record_id)
+            )
 
-                await session.execute(query)
-                await session.commit()
+            await session.execute(query)
 
-        finally:
-            await session.close()
+            if ledger:
+                await ledger.rebuild(session, ledger_orgs)
+
+            await session.commit()
 
     @classmethod
     async def execute_sql(cls, query):
-        try:
-            async with async_session_factory() as session:
-                db_response = await session.execute(text(query))
-                return db_response.all()
-
-        finally:
-            await session.close()
+        async with session_scope() as session:
+            db_response = await session.execute(text(query))
+            return db_response.all()
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Request, Depends
+from fastapi import APIRouter, Request, Depends, HTTPException
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse
 
@@ -7,10 +7,12 @@ from auth.models import UserSessionModel
 from auth.schemas import UserReadSchema
 from auth.router import every
 from admin.router import every as admin_every
-from database import Repository
+from config import S3ENDPOINT, S3BUCKET, IMAGE_RENDITIONS
+from database import Repository, rendition_name
 from orgs.models import OrganizationModel
 from orgs.repository import MembershipRepository
 from payments.models import BalanceBillModel
+from strings import *
 
 router = APIRouter()
 
@@ -284,6 +286,35 @@ async def page(request: Request,
     return templates.TemplateResponse('user-settings-security.html', {'request': request})
 
 
+# MEDIA
+@router.get('/media/{rendition}/{file_name}')
+async def media_rendition(rendition: str, file_name: str,
+                          session: UserSessionModel = Depends(every),
+                          admin_session: AdminSessionModel = Depends(admin_every)):
+    # a missing rendition costs a download and a transcode, only signed in users and admins may request it
+    if not session and not admin_session:
+        raise HTTPException(status_code=401, detail=string_401)
+
+    if rendition not in IMAGE_RENDITIONS:
+        raise HTTPException(status_code=404, detail=string_404)
+
+    file_info = file_name.rsplit('.', maxsplit=1)
+
+    # only transcoded images have renditions
+    if len(file_info) < 2 or file_info[1] != 'webp':
+        return RedirectResponse(f'{S3ENDPOINT}/{S3BUCKET}/{file_name}')
+
+    try:
+        await Repository.s3_save_renditions(file_name, [rendition])
+    except Exception:
+        raise HTTPException(status_code=404, detail=string_404)
+
+    return RedirectResponse(
+        f'{S3ENDPOINT}/{S3BUCKET}/{rendition_name(file_info[0], rendition)}',
+        headers={'Cache-Control': 'public, max-age=604800'}
+    )
+
+
 # UTILITY PAGES
 @router.get('/403')
 async def page(request: Request,
@@ -1,5 +1,7 @@
 from config import HASHSALT
 from hashlib import pbkdf2_hmac
+from PIL import Image, ImageOps
+import io
 import random
 import string
 
@@ -13,3 +15,26 @@ class Strings:
     def alphanumeric(cls, length: int) -> str:
         characters = string.ascii_letters + string.digits
         return ''.join(random.choice(characters) for _ in range(length))
+
+
+class Images:
+    @classmethod
+    def to_webp(cls, file_bytes: bytes, sizes: dict, quality: int) -> dict:
+        max_side = max(max(size) for size in sizes.values())
+        image = Image.open(io.BytesIO(file_bytes))
+
+        # let jpeg decoder downscale while reading
+        image.draft(image.mode, (max_side, max_side))
+
+        image = ImageOps.exif_transpose(image)
+
+        # one decode for every size, largest first so each one is shrunk from the previous
+        encoded = {}
+        for key, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            image.thumbnail(size)
+
+            webp_bytes = io.BytesIO()
+            image.save(webp_bytes, format='WEBP', quality=quality)
+            encoded[key] = webp_bytes.getvalue()
+
+        return encoded
@@ -1,4 +1,7 @@
-from fastapi import FastAPI
+import asyncio
+import contextlib
+
+from fastapi import FastAPI, Depends
 from fastapi.staticfiles import StaticFiles
 
 from auth.router import router as router_auth
@@ -11,8 +14,18 @@ from products.router import router_reviews
 from orders.router import router as router_orders
 from admin.router import router as admin_router
 from picker.router import router as picker_router
+from picker.jobs import watch_jobs
+from database import request_session_scope
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    watcher = asyncio.create_task(watch_jobs())
+    yield
+    watcher.cancel()
+
 
-app = FastAPI(title='GreedyBear')
+app = FastAPI(title='GreedyBear', lifespan=lifespan, dependencies=[Depends(request_session_scope)])
 app.mount('/static', StaticFiles(directory='frontend/static'), name='static')
 
 app.include_router(router_auth)
@@ -1,5 +1,5 @@
 from typing import Annotated
-from sqlalchemy import text, ForeignKey
+from sqlalchemy import text, ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 import datetime
 
@@ -71,6 +71,10 @@ class OrderAddressStatusModel(Base):
 # Order
 class OrdersOrderModel(Base):
     __tablename__ = 'orders_order'
+    __table_args__ = (
+        # weekly purchases count per organization
+        Index('ix_orders_order_product_id_dt_ordered', 'product_id', 'dt_ordered'),
+    )
 
     id: Mapped[pk]
 
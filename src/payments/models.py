@@ -70,6 +70,20 @@ class BalanceHistoryModel(Base):
     target: Mapped['BalanceTargetModel'] = relationship(lazy=False)
 
 
+class BalanceSnapshotModel(Base):
+    __tablename__ = 'balance_snapshot'
+
+    # running balance of organization, changed in the same transaction as its balance_history
+    id: Mapped[pk]
+    amount: Mapped[int]
+    date: Mapped[dt]
+
+    # FK
+    org_id: Mapped[int] = mapped_column(
+        ForeignKey('organization.id', ondelete='CASCADE', onupdate='CASCADE'), unique=True
+    )
+
+
 class BalanceBillStatusModel(Base):
     __tablename__ = 'balance_bill_status'
 
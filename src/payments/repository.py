@@ -1,23 +1,178 @@
-from sqlalchemy import select, update
+from sqlalchemy import select, update, func, case, literal, union_all
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import selectinload
 
-from database import async_session_factory
+from database import session_scope
 from orders.models import OrdersOrderModel
-from payments.models import BalanceBillModel, BalanceSourceModel, BalanceHistoryModel
+from products.models import ProductModel
+from payments.models import (
+    BalanceBillModel, BalanceSourceModel, BalanceHistoryModel, BalanceSnapshotModel, BalanceActionModel,
+    BalanceTargetModel
+)
+
+# actions 1, 4: top up, 2, 3: write off
+balance_amount = case(
+    (BalanceHistoryModel.action_id.in_([1, 4]), BalanceHistoryModel.amount),
+    (BalanceHistoryModel.action_id.in_([2, 3]), -BalanceHistoryModel.amount),
+    else_=0
+)
 
 
 class PaymentsRepository:
     @classmethod
     async def create_bill(cls, data: dict):
-        try:
-            async with async_session_factory() as session:
+        async with session_scope() as session:
 
-                bill = BalanceBillModel(**data)
-                session.add(bill)
-                await session.commit()
-                await session.refresh(bill)
+            bill = BalanceBillModel(**data)
+            session.add(bill)
+            await session.commit()
+            await session.refresh(bill)
+
+            return bill.id
+
+    @classmethod
+    async def get_org_balance(cls, org_id: int) -> int:
+        async with session_scope() as session:
+
+            amount = await session.scalar(
+                select(BalanceSnapshotModel.amount).where(BalanceSnapshotModel.org_id == org_id)
+            )
+
+            # organization without snapshot yet
+            if amount is None:
+                amount = await session.scalar(
+                    select(func.coalesce(func.sum(balance_amount), 0)).where(BalanceHistoryModel.org_id == org_id)
+                )
+
+            return int(amount)
+
+    @classmethod
+    async def get_balances(cls) -> dict[int, int]:
+        async with session_scope() as session:
+
+            # organizations without snapshot yet are summed from history
+            query = union_all(
+                select(BalanceSnapshotModel.org_id, BalanceSnapshotModel.amount),
+                select(BalanceHistoryModel.org_id, func.coalesce(func.sum(balance_amount), 0))
+                .where(BalanceHistoryModel.org_id.not_in(select(BalanceSnapshotModel.org_id)))
+                .group_by(BalanceHistoryModel.org_id)
+            )
+
+            db_response = await session.execute(query)
+
+            return {org_id: int(amount) for org_id, amount in db_response.all()}
+
+    @classmethod
+    async def count_purchases(cls, org_id: int, ws, we) -> int:
+        async with session_scope() as session:
+
+            return await session.scalar(
+                select(func.count(OrdersOrderModel.id))
+                .join(ProductModel, OrdersOrderModel.product_id == ProductModel.id)
+                .where(ProductModel.org_id == org_id)
+                .where(OrdersOrderModel.dt_ordered.isnot(None))
+                .where(OrdersOrderModel.dt_ordered > ws)
+                .where(OrdersOrderModel.dt_ordered < we)
+            )
+
+
+class BalanceLedgerRepository:
+    # balance_history columns that follow updates and deletes of the parent rows.
+    # a deleted organization takes its snapshot along, changes made outside Repository are fixed by /reconcileBalances
+    cascades = {
+        BalanceActionModel.__name__: BalanceHistoryModel.action_id,
+        BalanceTargetModel.__name__: BalanceHistoryModel.target_id,
+    }
+
+    @classmethod
+    def full_amount(cls, org_id: int):
+        return (
+            select(literal(org_id), func.coalesce(func.sum(balance_amount), 0))
+            .where(BalanceHistoryModel.org_id == org_id)
+        )
 
-                return bill.id
+    @classmethod
+    async def add(cls, session, model, records: list[dict]):
+        # new actions and targets have no history yet
+        if model is not BalanceHistoryModel:
+            return
+
+        deltas = {}
+        for record in records:
+            if record['action_id'] in [1, 4]:
+                delta = record['amount']
+            elif record['action_id'] in [2, 3]:
+                delta = -record['amount']
+            else:
+                delta = 0
+
+            deltas[record['org_id']] = deltas.get(record['org_id'], 0) + delta
+
+        for org_id, delta in deltas.items():
+            db_response = await session.execute(
+                update(BalanceSnapshotModel)
+                .where(BalanceSnapshotModel.org_id == org_id)
+                .values(amount=BalanceSnapshotModel.amount + delta, date=func.now())
+            )
+
+            if db_response.rowcount:
+                continue
+
+            # first snapshot of organization is the full sum, which already includes the new records.
+            # if another transaction created it meanwhile, its sum misses these records, so only delta is added
+            query = postgresql.insert(BalanceSnapshotModel).from_select(
+                ['org_id', 'amount'], cls.full_amount(org_id)
+            )
+            await session.execute(
+                query.on_conflict_do_update(
+                    index_elements=[BalanceSnapshotModel.org_id],
+                    set_={'amount': BalanceSnapshotModel.amount + delta, 'date': func.now()}
+                )
+            )
+
+    @classmethod
+    async def orgs_of(cls, session, model, record_ids: list[int]) -> set[int]:
+        column = cls.cascades.get(model.__name__, BalanceHistoryModel.id)
+
+        db_response = await session.scalars(
+            select(BalanceHistoryModel.org_id).where(column.in_(record_ids)).distinct()
+        )
+
+        return set(db_response.all())
+
+    @classmethod
+    async def rebuild(cls, session, org_ids):
+        for org_id in org_ids:
+            query = postgresql.insert(BalanceSnapshotModel).from_select(
+                ['org_id', 'amount'], cls.full_amount(org_id)
+            )
+            await session.execute(
+                query.on_conflict_do_update(
+                    index_elements=[BalanceSnapshotModel.org_id],
+                    set_={'amount': query.excluded.amount, 'date': func.now()}
+                )
+            )
+
+    @classmethod
+    async def reconcile(cls, fix: bool = False) -> dict[int, dict]:
+        async with session_scope() as session:
+
+            db_response = await session.execute(
+                select(BalanceHistoryModel.org_id, func.sum(balance_amount)).group_by(BalanceHistoryModel.org_id)
+            )
+            totals = {org_id: int(amount) for org_id, amount in db_response.all()}
+
+            db_response = await session.execute(select(BalanceSnapshotModel.org_id, BalanceSnapshotModel.amount))
+            snapshots = {org_id: amount for org_id, amount in db_response.all()}
+
+            mismatches = {
+                org_id: {'history': totals.get(org_id, 0), 'snapshot': snapshots.get(org_id)}
+                for org_id in totals.keys() | snapshots.keys()
+                if totals.get(org_id, 0) != snapshots.get(org_id)
+            }
+
+            if fix and mismatches:
+                await cls.rebuild(session, list(mismatches))
+                await session.commit()
 
-        finally:
-            await session.close()
+            return mismatches
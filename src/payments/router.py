@@ -8,7 +8,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from database import Repository
 from orders.models import OrdersOrderModel
 from payments.repository import PaymentsRepository
-from payments.utils import payment_week, get_previous_week_dates, get_current_week_dates
+from payments.utils import payment_week, get_previous_week_dates, get_current_week_dates, levels_cache
 from products.models import ProductModel
 from strings import *
 from auth.router import authed
@@ -35,45 +35,37 @@ router = APIRouter(
 async def current_prices(organization):
     ws, we = get_previous_week_dates()
 
-    if not organization.level_id:
-        purchases = await get_purchases_count(ws, we, organization.id)
-        levels = await get_public_levels()
-        selected_level = next((level for level in levels if purchases < level.amount), levels[-1])
-    else:
-        purchases = await get_purchases_count(ws, we, organization.id)
-        levels = await get_level_by_id(organization.level_id)
-        selected_level = levels
+    # previous week purchases are final, the level only changes with the levels table or the organization
+    cached = levels_cache.get(organization, ws)
+    if cached:
+        return cached
 
+    generation = levels_cache.generation
+    selected_level, purchases = await resolve_level(organization, ws, we)
+
+    levels_cache.set(organization, ws, (selected_level, purchases), generation)
     return selected_level, purchases
 
 
 async def nex_prices(organization):
     ws, we = get_current_week_dates()
+    return await resolve_level(organization, ws, we)
+
+
+async def resolve_level(organization, ws, we):
+    purchases = await get_purchases_count(ws, we, organization.id)
 
     if not organization.level_id:
-        purchases = await get_purchases_count(ws, we, organization.id)
         levels = await get_public_levels()
         selected_level = next((level for level in levels if purchases < level.amount), levels[-1])
     else:
-        purchases = await get_purchases_count(ws, we, organization.id)
-        levels = await get_level_by_id(organization.level_id)
-        selected_level = levels
+        selected_level = await get_level_by_id(organization.level_id)
 
     return selected_level, purchases
 
 
 async def get_purchases_count(ws, we, org_id):
-    return len(await Repository.get_records(
-        model=OrdersOrderModel,
-        filters=[
-            OrdersOrderModel.dt_ordered is not None,
-            OrdersOrderModel.dt_ordered > ws,
-            OrdersOrderModel.dt_ordered < we,
-        ],
-        select_related=[OrdersOrderModel.product],
-        joins=[ProductModel],
-        filtration=[ProductModel.org_id == org_id]
-    ))
+    return await PaymentsRepository.count_purchases(org_id, ws, we)
 
 
 async def get_public_levels():
@@ -95,22 +87,7 @@ async def get_level_by_id(level_id):
 
 
 async def get_current_balance(org_id):
-    history = await Repository.get_records(
-        BalanceHistoryModel,
-        filters=[BalanceHistoryModel.org_id == org_id]
-    )
-    total = 0
-    for record in history:
-        if record.action_id == 1:
-            total += record.amount
-        elif record.action_id == 2:
-            total -= record.amount
-        elif record.action_id == 3:
-            total -= record.amount
-        elif record.action_id == 4:
-            total += record.amount
-
-    return total
+    return await PaymentsRepository.get_org_balance(org_id)
 
 
 @router.get('/currentBalance')
@@ -123,13 +100,7 @@ async def current_level(org_id: int, session: UserSessionModel = Depends(authed)
 async def current_level(org_id: int, session: UserSessionModel = Depends(authed)):
     organization, membership = await check_access(org_id, session.user.id, 62)
 
-    if organization.level_id:
-        level = await get_level_by_id(organization.level_id)
-        ws, we = get_previous_week_dates()
-        purchases = await get_purchases_count(ws, we, organization.id)
-
-    else:
-        level, purchases = await current_prices(organization)
+    level, purchases = await current_prices(organization)
 
     return {
         'level': BalanceLevelSchema.model_validate(level, from_attributes=True),
@@ -148,13 +119,7 @@ async def get_levels(org_id: int, session: UserSessionModel = Depends(authed)):
         order_by=[BalancePricesModel.number.asc()]
     )
 
-    if organization.level_id:
-        level = await get_level_by_id(organization.level_id)
-        ws, we = get_current_week_dates()
-        purchases = await get_purchases_count(ws, we, organization.id)
-
-    else:
-        level, purchases = await nex_prices(organization)
+    level, purchases = await nex_prices(organization)
 
     return {
         'all': [BalanceLevelSchema.model_validate(level, from_attributes=True) for level in levels],
@@ -227,24 +192,7 @@ async def create_organization(org_id: int,
 async def create_organization(org_id: int, session: UserSessionModel = Depends(authed)):
     await check_access(org_id, session.user.id, 32)
 
-    try:
-        int(org_id)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=string_400)
-
-    query = 'SELECT SUM(' \
-            'CASE ' \
-            'WHEN action_id IN (1, 4) THEN amount ' \
-            'WHEN action_id IN (2, 3) THEN -amount ' \
-            'ELSE 0 ' \
-            'END) AS total_amount ' \
-            'FROM balance_history ' \
-            f'WHERE org_id = {org_id};'
-
-
-    result = await Repository.execute_sql(query)
-
-    return result[0][0]
+    return await get_current_balance(org_id)
 
 
 @router.post('/updateBillStatus')
@@ -1,4 +1,7 @@
 import datetime
+import time
+
+from config import LEVELS_CACHE_TTL
 
 
 async def payment_week(created_at):
@@ -23,3 +26,49 @@ def get_previous_week_dates():
     previous_monday = today - datetime.timedelta(days=today.weekday() + 7)
     previous_sunday = previous_monday + datetime.timedelta(days=6)
     return previous_monday, previous_sunday
+
+
+class LevelsCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.generation = 0
+        self.metrics = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, organization, ws):
+        entry = self.entries.get((organization.id, ws))
+
+        # expired or organization level changed since caching
+        if entry is None or entry[0] < time.monotonic() or entry[1] != organization.level_id:
+            self.entries.pop((organization.id, ws), None)
+            self.metrics['misses'] += 1
+            return None
+
+        self.metrics['hits'] += 1
+        return entry[2]
+
+    def set(self, organization, ws, value, generation):
+
+        # invalidated while resolving
+        if generation != self.generation:
+            return
+
+        now = time.monotonic()
+        for key in [key for key, entry in self.entries.items() if entry[0] < now]:
+            del self.entries[key]
+
+        self.entries[(organization.id, ws)] = (now + self.ttl, organization.level_id, value)
+
+    def invalidate(self, org_id=None):
+        self.generation += 1
+        self.metrics['invalidations'] += 1
+
+        if org_id is None:
+            self.entries.clear()
+            return
+
+        for key in [key for key in self.entries if key[0] == org_id]:
+            del self.entries[key]
+
+
+levels_cache = LevelsCache(LEVELS_CACHE_TTL)
@@ -0,0 +1,143 @@
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from config import PICKER_JOB_WORKERS, PICKER_PROCESS_WORKERS, PICKER_JOB_HEARTBEAT
+from database import Repository, request_context
+from picker.models import PickerJobModel
+from picker.repository import PickerJobsRepository
+from strings import *
+
+jobs_semaphore = asyncio.Semaphore(PICKER_JOB_WORKERS)
+# {job id: task} of jobs submitted in this worker
+running_jobs = {}
+process_pool = None
+logger = logging.getLogger(__name__)
+
+
+class PickerJob:
+    id = None
+    percent = None
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.percent = 0
+
+    async def progress(self, percent):
+        percent = min(int(percent), 99)
+
+        if percent <= self.percent:
+            return
+
+        self.percent = percent
+        await update_job(self.id, progress=percent)
+
+
+async def run_in_process(func, *args):
+    global process_pool
+
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(max_workers=PICKER_PROCESS_WORKERS)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(process_pool, functools.partial(func, *args))
+
+
+async def update_job(job_id, **values):
+    await Repository.save_records([{'model': PickerJobModel, 'records': [{'id': job_id, **values}]}])
+
+
+async def finish_job(job_id, **values):
+    if not await PickerJobsRepository.finish_job(job_id, values):
+        logger.warning('picker job %s is no longer running, status %s is not saved', job_id, values.get('status'))
+
+
+async def cooperative(lines, every=1000):
+    # long loops of a job give the event loop a turn, heartbeats and requests of the worker keep running
+    for i, line in enumerate(lines):
+        if i % every == 0:
+            await asyncio.sleep(0)
+
+        yield line
+
+
+def spool_uploads(data):
+    spooled_data, paths = {}, []
+
+    for key, value in data.items():
+        if not hasattr(value, 'file'):
+            spooled_data[key] = value
+            continue
+
+        value.file.seek(0)
+        with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as spooled:
+            shutil.copyfileobj(value.file, spooled)
+
+        spooled_data[key] = spooled.name
+        paths.append(spooled.name)
+
+    return spooled_data, paths
+
+
+async def run_job(job, pipeline, args, files):
+    # the task outlives the request it was submitted from, so it must not use the request session
+    request_context.set(None)
+
+    try:
+        async with jobs_semaphore:
+            await update_job(job.id, status=2)
+
+            try:
+                result = await pipeline(*args, job=job)
+
+            except Exception as e:
+                await finish_job(job.id, status=4, detail=str(e))
+
+            else:
+                try:
+                    await finish_job(job.id, status=3, progress=100, result=result)
+                except Exception as e:
+                    await finish_job(job.id, status=4, detail=str(e))
+
+    finally:
+        for path in files:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+async def submit_job(job_type, session, pipeline, *args, files=None):
+    job_id = await PickerJobsRepository.create_job(
+        {
+            'type': job_type,
+            'status': 1,
+            'progress': 0,
+            'session_id': session.id,
+        }
+    )
+
+    task = asyncio.create_task(run_job(PickerJob(job_id), pipeline, args, files or []))
+    running_jobs[job_id] = task
+    task.add_done_callback(lambda _: running_jobs.pop(job_id, None))
+
+    return job_id
+
+
+async def watch_jobs():
+    # jobs live in worker memory, a job left queued or running by a restarted worker stops getting heartbeats
+    request_context.set(None)
+
+    while True:
+        try:
+            if running_jobs:
+                await PickerJobsRepository.touch_jobs(list(running_jobs))
+
+            await PickerJobsRepository.fail_stale_jobs(PICKER_JOB_HEARTBEAT * 3, string_picker_job_lost)
+
+        except Exception:
+            logger.exception('picker jobs heartbeat failed')
+
+        await asyncio.sleep(PICKER_JOB_HEARTBEAT)
@@ -1,5 +1,5 @@
 from typing import Annotated
-from sqlalchemy import text, ForeignKey
+from sqlalchemy import text, ForeignKey, JSON
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 import datetime
 
@@ -40,11 +40,33 @@ class PickerHistoryModel(Base):
     server_id: Mapped[int] = mapped_column(
         ForeignKey('orders_server.id', ondelete='CASCADE', onupdate='CASCADE')
     )
+    job_id: Mapped[int | None] = mapped_column(
+        ForeignKey('admin_picker_job.id', ondelete='SET NULL', onupdate='CASCADE')
+    )
 
     # Relationships
     server: Mapped['PickerServerModel'] = relationship(lazy=False)
 
 
+class PickerJobModel(Base):
+    __tablename__ = 'admin_picker_job'
+
+    # status 1: queued, 2: running, 3: done, 4: failed
+    id: Mapped[pk]
+    date: Mapped[dt]
+    type: Mapped[str]
+    status: Mapped[int]
+    progress: Mapped[int] = mapped_column(default=0)
+    detail: Mapped[str | None]
+    result: Mapped[dict | None] = mapped_column(JSON)
+    heartbeat: Mapped[datetime.datetime | None]
+
+    # FK
+    session_id: Mapped[int | None] = mapped_column(
+        ForeignKey('admin_user_sessions.id', ondelete='SET NULL', onupdate='CASCADE')
+    )
+
+
 # Server
 class PickerServerContractorModel(Base):
     __tablename__ = 'orders_server_contractor'
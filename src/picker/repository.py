@@ -0,0 +1,60 @@
+import datetime
+
+from sqlalchemy import update, func, or_, and_
+
+from database import session_scope
+from picker.models import PickerJobModel
+
+
+class PickerJobsRepository:
+
+    @classmethod
+    async def create_job(cls, data: dict):
+        async with session_scope() as session:
+
+            job = PickerJobModel(**data)
+            session.add(job)
+            await session.commit()
+            await session.refresh(job)
+
+            return job.id
+
+    @classmethod
+    async def touch_jobs(cls, job_ids: list):
+        async with session_scope() as session:
+            await session.execute(
+                update(PickerJobModel)
+                .where(PickerJobModel.id.in_(job_ids))
+                .values(heartbeat=func.now())
+            )
+            await session.commit()
+
+    @classmethod
+    async def finish_job(cls, job_id: int, values: dict):
+        # a running job only, the watcher may have failed it as lost meanwhile
+        async with session_scope() as session:
+            result = await session.execute(
+                update(PickerJobModel)
+                .where(PickerJobModel.id == job_id, PickerJobModel.status == 2)
+                .values(**values)
+            )
+            await session.commit()
+
+            return result.rowcount > 0
+
+    @classmethod
+    async def fail_stale_jobs(cls, timeout: int, detail: str):
+        deadline = func.now() - datetime.timedelta(seconds=timeout)
+
+        # queued or running jobs whose worker stopped reporting
+        async with session_scope() as session:
+            await session.execute(
+                update(PickerJobModel)
+                .where(PickerJobModel.status.in_([1, 2]))
+                .where(or_(
+                    PickerJobModel.heartbeat < deadline,
+                    and_(PickerJobModel.heartbeat.is_(None), PickerJobModel.date < deadline)
+                ))
+                .values(status=4, detail=detail)
+            )
+            await session.commit()
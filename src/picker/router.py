@@ -5,12 +5,15 @@ from fastapi import APIRouter, Depends, Response, Request, HTTPException, Upload
 from admin.models import AdminSessionModel
 from admin.router import authed
 
-from picker.utils import refresh_active_and_collected, generate_plan_xlsx_2, generate_plan_main
+from picker.jobs import submit_job, spool_uploads, run_in_process
+from picker.utils import refresh_active_and_collected, generate_plan_xlsx_2, generate_plan_main, table_to_xlsx, \
+    PLAN_OUTPUT_FORMATS
 from picker.models import PickerServerScheduleModel, PickerSettingsModel, PickerServerContractorModel, \
-    PickerHistoryModel, PickerServerModel
+    PickerHistoryModel, PickerServerModel, PickerJobModel
 
 from gutils import Strings
 from database import Repository
+from strings import *
 
 router = APIRouter(
     prefix="/picker",
@@ -38,14 +41,18 @@ async def refresh_orders(request: Request, session: AdminSessionModel = Depends(
         if not data.get(f'plan-{server.id}', None) or data.get(f'plan-{server.id}') == 'undefined':
             raise HTTPException(status_code=400, detail=f'Отсутствует файл плана для {server.name}')
 
+    data, files = spool_uploads(data)
+    job_id = await submit_job('refresh', session, refresh_active_and_collected, data, servers, session, files=files)
 
-    return await refresh_active_and_collected(data, servers, session)
-
-
+    return {'job_id': job_id}
 
 
 @router.post('/generatePlan')
-async def generate_plan(request: Request, date: datetime.date, session: AdminSessionModel = Depends(authed)):
+async def generate_plan(request: Request, date: datetime.date, output_format: str = 'xlsx',
+                        session: AdminSessionModel = Depends(authed)):
+    if output_format not in PLAN_OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f'Неизвестный формат {output_format}')
+
     servers = await Repository.get_records(
         PickerServerModel,
         filters=[PickerServerModel.is_active],
@@ -55,18 +62,92 @@ async def generate_plan(request: Request, date: datetime.date, session: AdminSes
     data = dict(await request.form())
     bad_accounts = data['bad_accounts']
 
-    try:
-        await generate_plan_main(servers, bad_accounts, date)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f'{str(e)}')
+    job_id = await submit_job('plan', session, generate_plan_main, servers, bad_accounts, date, output_format)
+
+    return {'job_id': job_id}
 
 
 @router.post('/generatePlan2')
-async def generate_plan(date: datetime.date, request: Request, session: AdminSessionModel = Depends(authed), ):
+async def generate_plan(date: datetime.date, request: Request, output_format: str = 'xlsx',
+                        session: AdminSessionModel = Depends(authed), ):
+    if output_format not in PLAN_OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f'Неизвестный формат {output_format}')
+
     servers = await Repository.get_records(
         PickerServerModel,
         filters=[PickerServerModel.is_active],
         select_related=[PickerServerModel.contractors, PickerServerModel.schedule]
     )
 
-    await generate_plan_xlsx_2(servers, date)
+    job_id = await submit_job('plan2', session, generate_plan_xlsx_2, servers, date, output_format)
+
+    return {'job_id': job_id}
+
+
+@router.get('/jobStatus')
+async def job_status(job_id: int, session: AdminSessionModel = Depends(authed)):
+    jobs = await Repository.get_records(PickerJobModel, filters=[PickerJobModel.id == job_id])
+
+    if len(jobs) != 1:
+        raise HTTPException(status_code=404, detail=string_404)
+
+    job = jobs[0]
+
+    return {
+        'id': job.id,
+        'type': job.type,
+        'status': job.status,
+        'progress': job.progress,
+        'detail': job.detail,
+    }
+
+
+@router.get('/jobResult')
+async def job_result(job_id: int, session: AdminSessionModel = Depends(authed)):
+    jobs = await Repository.get_records(PickerJobModel, filters=[PickerJobModel.id == job_id])
+
+    if len(jobs) != 1:
+        raise HTTPException(status_code=404, detail=string_404)
+
+    job = jobs[0]
+
+    if job.status == 4:
+        raise HTTPException(status_code=500, detail=job.detail)
+
+    if job.status != 3:
+        raise HTTPException(status_code=409, detail=string_409)
+
+    history = await Repository.get_records(PickerHistoryModel, filters=[PickerHistoryModel.job_id == job.id])
+
+    return {
+        'result': job.result,
+        'history': [record.__dict__ for record in history],
+    }
+
+
+@router.get('/historyXlsx')
+async def history_xlsx(history_id: int, target: str, session: AdminSessionModel = Depends(authed)):
+    history = await Repository.get_records(PickerHistoryModel, filters=[PickerHistoryModel.id == history_id])
+
+    if len(history) != 1 or target not in ['result', 'logs']:
+        raise HTTPException(status_code=404, detail=string_404)
+
+    file_name = getattr(history[0], target)
+
+    if not file_name or file_name == '-':
+        raise HTTPException(status_code=404, detail=string_404)
+
+    content = await Repository.s3_read(file_name)
+
+    if not file_name.endswith(PLAN_OUTPUT_FORMATS['xlsx']):
+        content = await run_in_process(table_to_xlsx, content, file_name)
+
+    headers = {
+        'Content-Disposition': f'attachment; filename={target}-{history_id}.xlsx'
+    }
+
+    return Response(
+        content=content,
+        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers=headers
+    )
@@ -1,16 +1,25 @@
-import copy
+import bisect
+import collections
 import datetime
 import io
+import numbers
 import operator
+import os
 import random
+import tempfile
 from io import BytesIO
 
+import numpy as np
 import openpyxl
 import pandas as pd
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import PatternFill
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string, get_column_letter
+from openpyxl.utils.exceptions import WorkbookAlreadySaved
 
 from database import Repository
 from gutils import Strings
+from picker.jobs import run_in_process, cooperative
 from orders.models import OrdersOrderModel, OrdersAccountModel, OrdersAddressModel
 from orgs.models import OrganizationModel
 from payments.models import BalanceHistoryModel
@@ -35,17 +44,123 @@ def detect_date(string_date):
     return result
 
 
-async def parse_excel_lines(excel_lines, columns):
-    return [
-        {
-            **{v: str(excel_line[n]) if str(excel_line[n]) != 'nan' else None for v, n in columns.items()},
-            'line_number': line_number + 2,
-        }
-        for line_number, excel_line in enumerate(excel_lines)
-    ]
+def excel_value(value):
+    if value is None:
+        return None
+
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+
+    value = str(value)
+    return value if value not in ('', 'nan') else None
+
+
+def read_excel_lines(file, columns, skip_empty=True):
+    book = openpyxl.load_workbook(file, read_only=True, data_only=True)
+
+    try:
+        sheet = book.worksheets[0]
+        empty_lines = []
+
+        for line_number, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
+            line = {
+                **{v: excel_value(row[n]) if n < len(row) else None for v, n in columns.items()},
+                'line_number': line_number,
+            }
+
+            # empty lines inside the table are kept on request, trailing ones are always dropped
+            if all(value is None for value in row):
+                if not skip_empty:
+                    empty_lines.append(line)
+                continue
+
+            yield from empty_lines
+            empty_lines = []
+
+            yield line
+
+    finally:
+        book.close()
+
+
+def read_excel_file(path, columns, skip_empty=True):
+    return list(read_excel_lines(path, columns, skip_empty))
+
+
+async def read_upload_lines(upload, columns, skip_empty=True):
+    if isinstance(upload, str):
+        return await run_in_process(read_excel_file, upload, columns, skip_empty)
+
+    await upload.seek(0)
+    return list(read_excel_lines(upload.file, columns, skip_empty))
+
+
+class RefreshIndex:
+    accounts = None
+    addresses = None
+    orders = None
+    uuids = None
+
+    def __init__(self, accounts, addresses, orders):
+        self.addresses = {}
+        self.orders = {}
+        self.uuids = {}
 
+        self.set_accounts(accounts)
 
-async def refresh_active_and_collected(data, servers, session):
+        for address in addresses:
+            self.addresses.setdefault(address.address, address.id)
+
+        for order in orders:
+            record = {
+                'id': order.id,
+                'ozon_price': order.ozon_price,
+                'sys_status': order.status,
+                'product_id': order.product_id,
+                'org_id': order.product.org_id,
+                'ozon_uuid': order.ozon_uuid,
+                'dt_collected': order.dt_collected,
+                'is_success': order.picker_status.is_success if order.picker_status else None
+            }
+
+            self.orders[order.id] = record
+
+            if order.ozon_uuid:
+                self.uuids.setdefault(order.ozon_uuid, record)
+
+    def set_accounts(self, accounts):
+        self.accounts = {}
+        for account in accounts:
+            self.accounts.setdefault(account.number, account.id)
+
+    def order(self, order_id):
+        try:
+            return self.orders.get(int(order_id))
+        except (TypeError, ValueError):
+            return None
+
+
+async def get_service_payments(order_ids, chunk_size=10000):
+    service_payments = {}
+    order_ids = list(order_ids)
+
+    for i in range(0, len(order_ids), chunk_size):
+        records = await Repository.get_records(
+            BalanceHistoryModel,
+            filters=[
+                BalanceHistoryModel.target_id.in_([2, 3, 4]),
+                BalanceHistoryModel.record_id.in_(order_ids[i:i + chunk_size]),
+                BalanceHistoryModel.action_id.in_([2, 3])
+            ]
+        )
+
+        for record in records:
+            service_payments.setdefault(record.record_id, []).append(record)
+
+    return service_payments
+
+
+async def refresh_active_and_collected(data, servers, session, job=None):
     # Caching data from db
     db_accounts = await Repository.get_records(OrdersAccountModel)
     db_addresses = await Repository.get_records(OrdersAddressModel)
@@ -56,22 +171,7 @@ async def refresh_active_and_collected(data, servers, session):
         select_related=[OrdersOrderModel.product, OrdersOrderModel.account, OrdersOrderModel.picker_status],
     )
 
-    df_accounts = pd.DataFrame([{'id': x.id, 'number': x.number} for x in db_accounts])
-    df_addresses = pd.DataFrame([{'id': x.id, 'address': x.address} for x in db_addresses])
-
-    df_orders = pd.DataFrame([
-        {
-            'id': x.id,
-            'ozon_price': x.ozon_price,
-            'sys_status': x.status,
-            'product_id': x.product_id,
-            'org_id': x.product.org_id,
-            'ozon_uuid': x.ozon_uuid,
-            'dt_collected': x.dt_collected,
-            'is_success': x.picker_status.is_success if x.picker_status else None
-        }
-        for x in db_orders
-    ])
+    index = RefreshIndex(db_accounts, db_addresses, db_orders)
 
     ac_excel_columns = {
         'address': 0,
@@ -101,39 +201,59 @@ async def refresh_active_and_collected(data, servers, session):
     logs_orders = []
     logs_payments = []
 
-    processed_accounts = []
-    processed_orders = []
+    processed_accounts = set()
+    processed_orders = set()
 
     data_orders_to_db = []
     data_payments_to_db = []
 
-    for server in servers:
+    for server_number, server in enumerate(servers):
+
+        if job:
+            await job.progress(server_number * 100 / len(servers))
 
         data_accounts_to_db = []
 
         # Reading xlsx files
-        active_orders_content = await data[f'active-{server.id}'].read()
-        collected_orders_content = await data[f'collected-{server.id}'].read()
-        plan_orders_content = await data[f'plan-{server.id}'].read()
-
         orders = {
-            'active': await parse_excel_lines(
-                pd.read_excel(BytesIO(active_orders_content), dtype=str).values.tolist(), ac_excel_columns),
-            'collected': await parse_excel_lines(
-                pd.read_excel(BytesIO(collected_orders_content), dtype=str).values.tolist(), ac_excel_columns),
+            'active': await read_upload_lines(data[f'active-{server.id}'], ac_excel_columns),
+            'collected': await read_upload_lines(data[f'collected-{server.id}'], ac_excel_columns),
         }
 
-        plan_orders = await parse_excel_lines(
-            pd.read_excel(BytesIO(plan_orders_content), dtype=str).values.tolist(), p_excel_columns)
+        plan_orders = await read_upload_lines(data[f'plan-{server.id}'], p_excel_columns)
 
+        plan_uuids = {}
         for plan_line in plan_orders:
             if plan_line['uuid'] and ',' in plan_line['uuid']:
                 plan_line['uuid'] = plan_line['uuid'].split(',')[-1].strip()
 
+            if plan_line['uuid']:
+                plan_uuids.setdefault(plan_line['uuid'], plan_line)
+
+        # Prefetching service payments of orders that can be refunded
+        candidate_orders = set()
+        for lines in orders.values():
+            async for line in cooperative(lines):
+                order = index.uuids.get(line['uuid']) if line['uuid'] else None
+
+                if not order and line['uuid'] in plan_uuids:
+                    order = index.order(plan_uuids[line['uuid']]['sid'])
+
+                if order:
+                    candidate_orders.add(order['id'])
+
+        async for plan_line in cooperative(plan_orders):
+            order = index.order(plan_line['sid'])
+
+            if order:
+                candidate_orders.add(order['id'])
+
+        service_payments_by_order = await get_service_payments(candidate_orders)
+
         # Process accounts
         for orders_type, lines in orders.items():
 
-            for line in reversed(lines):
+            async for line in cooperative(reversed(lines)):
 
                 if line['account_number'] in processed_accounts:
                     continue
@@ -180,12 +300,10 @@ async def refresh_active_and_collected(data, servers, session):
                     )
                     continue
 
-                query = df_accounts.query(f"number == '{line['account_number']}'")
-                account_id = query['id'].iloc[0] if len(query.values) != 0 else None
+                account_id = index.accounts.get(line['account_number'])
 
                 if not account_id:
-                    query = df_addresses.query(f"address == '{line['address']}'")
-                    address_id = query['id'].iloc[0] if len(query.values) != 0 else None
+                    address_id = index.addresses.get(line['address'])
 
                     if not address_id:
                         logs_accounts.append(
@@ -223,18 +341,18 @@ async def refresh_active_and_collected(data, servers, session):
                         }
                     )
 
-                processed_accounts.append(line['account_number'])
+                processed_accounts.add(line['account_number'])
 
         # Save and recache accounts
         if data_accounts_to_db:
             await Repository.save_records([{'model': OrdersAccountModel, 'records': data_accounts_to_db}])
             db_accounts = await Repository.get_records(OrdersAccountModel)
-            df_accounts = pd.DataFrame([{'id': x.id, 'number': x.number} for x in db_accounts])
+            index.set_accounts(db_accounts)
 
         # Process orders
         for orders_type, lines in orders.items():
 
-            for line in reversed(lines):
+            async for line in cooperative(reversed(lines)):
 
                 # Searching order_id (sid) by uuid in files and data verify
                 if not line['uuid']:
@@ -252,22 +370,15 @@ async def refresh_active_and_collected(data, servers, session):
                     )
                     continue
 
-                query = df_orders.query(f"ozon_uuid == '{line['uuid']}'")
-                order_id = query['id'].iloc[0] if len(query.values) != 0 else None
+                order = index.uuids.get(line['uuid'])
 
-                if order_id:
+                if order:
 
-                    if orders_type == 'collected' and query['dt_collected'].iloc[0]:
+                    if orders_type == 'collected' and order['dt_collected']:
                         continue
 
                 else:
-                    found_order_in_plan_orders = None
-
-                    for plan_line in plan_orders:
-
-                        if plan_line['uuid'] == line['uuid']:
-                            found_order_in_plan_orders = plan_line
-                            break
+                    found_order_in_plan_orders = plan_uuids.get(line['uuid'])
 
                     if not found_order_in_plan_orders:
                         logs_orders.append(
@@ -299,10 +410,9 @@ async def refresh_active_and_collected(data, servers, session):
                         )
                         continue
 
-                    query = df_orders.query(f"id == {found_order_in_plan_orders['sid']}")
-                    order_id = query['id'].iloc[0] if len(query.values) != 0 else None
+                    order = index.order(found_order_in_plan_orders['sid'])
 
-                    if not order_id:
+                    if not order:
                         logs_orders.append(
                             {
                                 'target': found_order_in_plan_orders['sid'],
@@ -318,12 +428,12 @@ async def refresh_active_and_collected(data, servers, session):
                         continue
 
                 # Refreshing order
-                query = df_orders.query(f"id == {order_id}")
+                order_id = order['id']
 
-                current_is_success = query['is_success'].iloc[0] if len(query.values) != 0 else None
-                current_sys_status = query['sys_status'].iloc[0] if len(query.values) != 0 else None
+                current_is_success = order['is_success']
+                current_sys_status = order['sys_status']
 
-                db_order_id = query['id'].iloc[0] if len(query.values) != 0 else None
+                db_order_id = order['id']
                 db_ozon_status = line['status']
                 db_uuid = line['uuid']
                 db_description = None
@@ -358,7 +468,7 @@ async def refresh_active_and_collected(data, servers, session):
                     )
                     continue
 
-                ozon_price = query['ozon_price'].iloc[0] if len(query.values) != 0 else None
+                ozon_price = order['ozon_price']
                 if not ozon_price:
                     logs_orders.append(
                         {
@@ -391,7 +501,7 @@ async def refresh_active_and_collected(data, servers, session):
                     )
                     continue
 
-                org_id = query['org_id'].iloc[0] if len(query.values) != 0 else None
+                org_id = order['org_id']
                 if not org_id:
                     logs_orders.append(
                         {
@@ -407,8 +517,7 @@ async def refresh_active_and_collected(data, servers, session):
                     )
                     continue
 
-                query = df_accounts.query(f"number == '{line['account_number']}'")
-                db_account_id = query['id'].iloc[0] if len(query.values) != 0 else None
+                db_account_id = index.accounts.get(line['account_number'])
 
                 if not db_account_id:
                     logs_orders.append(
@@ -498,16 +607,7 @@ async def refresh_active_and_collected(data, servers, session):
 
                     if status_model.refund_services:
 
-                        service_payments = await Repository.get_records(
-                            BalanceHistoryModel,
-                            filters=[
-                                BalanceHistoryModel.target_id.in_([2, 3, 4]),
-                                BalanceHistoryModel.record_id == db_order_id,
-                                BalanceHistoryModel.action_id.in_([2, 3])
-                            ]
-                        )
-
-                        for service_payment in service_payments:
+                        for service_payment in service_payments_by_order.get(db_order_id, []):
                             data_payments_to_db.append(
                                 {
                                     'amount': service_payment.amount,
@@ -561,10 +661,10 @@ async def refresh_active_and_collected(data, servers, session):
                     }
                 )
 
-                processed_orders.append(str(db_order_id))
+                processed_orders.add(str(db_order_id))
 
         # Checking plan to refund bad orders
-        for line in plan_orders:
+        async for line in cooperative(plan_orders):
 
             if not line['sid']:
                 logs_orders.append(
@@ -598,10 +698,9 @@ async def refresh_active_and_collected(data, servers, session):
 
             if 'Все артикулы заказаны' not in line['status'] and line['sid'] not in processed_orders:
 
-                query = df_orders.query(f"id == {line['sid']}")
-                order_id = query['id'].iloc[0] if len(query.values) != 0 else None
+                order = index.order(line['sid'])
 
-                if not order_id:
+                if not order:
                     logs_orders.append(
                         {
                             'target': line['sid'],
@@ -616,7 +715,9 @@ async def refresh_active_and_collected(data, servers, session):
                     )
                     continue
 
-                ozon_price = query['ozon_price'].iloc[0] if len(query.values) != 0 else None
+                order_id = order['id']
+
+                ozon_price = order['ozon_price']
                 if not ozon_price:
                     logs_orders.append(
                         {
@@ -632,7 +733,7 @@ async def refresh_active_and_collected(data, servers, session):
                     )
                     continue
 
-                org_id = query['org_id'].iloc[0] if len(query.values) != 0 else None
+                org_id = order['org_id']
                 if not org_id:
                     logs_orders.append(
                         {
@@ -670,16 +771,7 @@ async def refresh_active_and_collected(data, servers, session):
                     }
                 )
 
-                service_payments = await Repository.get_records(
-                    BalanceHistoryModel,
-                    filters=[
-                        BalanceHistoryModel.target_id.in_([2, 3, 4]),
-                        BalanceHistoryModel.record_id == order_id,
-                        BalanceHistoryModel.action_id.in_([2, 3])
-                    ]
-                )
-
-                for service_payment in service_payments:
+                for service_payment in service_payments_by_order.get(order_id, []):
                     data_payments_to_db.append(
                         {
                             'amount': service_payment.amount,
@@ -742,8 +834,49 @@ async def refresh_active_and_collected(data, servers, session):
     return {'accounts': logs_accounts, 'orders': logs_orders, 'payments': logs_payments}
 
 
-async def generate_plan_xlsx_2(servers, date):
-    for server in servers:
+def build_plan_file(db_tasks, date, output_format):
+    ws_res = SheetBuffer('Sheet')
+    ws_res['B1'] = 'артикул'
+    ws_res['C1'] = 'кол-во'
+    ws_res['D1'] = 'размер'
+    ws_res['E1'] = 'ключевой запрос'
+    ws_res['F1'] = 'вход'
+    ws_res['G1'] = 'ПВЗ'
+    ws_res['H1'] = 'подсказка'
+    ws_res['I1'] = 'порядок'
+    ws_res['K1'] = 'статус'
+    ws_res['L1'] = 'аккаунт'
+    ws_res['M1'] = 'id заказа'
+    ws_res['N1'] = 'ип'
+    ws_res['O1'] = 'цена'
+    ws_res['P1'] = 'sid'
+    ws_res['Z2'] = date.strftime('%d.%m')
+
+    ln = 1
+    for task in db_tasks:
+        ln += 1
+        ws_res[f'A{ln}'] = ln - 1
+        ws_res[f'B{ln}'] = task['article']
+        ws_res[f'C{ln}'] = 1
+        ws_res[f'D{ln}'] = task['size']
+        ws_res[f'E{ln}'] = task['keyword']
+        ws_res[f'N{ln}'] = task['org']
+        ws_res[f'O{ln}'] = task['price']
+        ws_res[f'P{ln}'] = task['id']
+
+    result_book = plan_book(output_format)
+    try:
+        result_book.write(ws_res)
+        return result_book.save()
+    finally:
+        result_book.close()
+
+
+async def generate_plan_xlsx_2(servers, date, output_format='xlsx', job=None):
+    for server_number, server in enumerate(servers):
+
+        if job:
+            await job.progress(server_number * 100 / len(servers))
 
         db_tasks = await Repository.get_records(
             model=OrdersOrderModel,
@@ -756,43 +889,13 @@ async def generate_plan_xlsx_2(servers, date):
             joins=[ProductModel, OrganizationModel],
         )
 
-        result_book = openpyxl.Workbook()
-
-        ws_res = result_book.active
-        ws_res['B1'] = 'артикул'
-        ws_res['C1'] = 'кол-во'
-        ws_res['D1'] = 'размер'
-        ws_res['E1'] = 'ключевой запрос'
-        ws_res['F1'] = 'вход'
-        ws_res['G1'] = 'ПВЗ'
-        ws_res['H1'] = 'подсказка'
-        ws_res['I1'] = 'порядок'
-        ws_res['K1'] = 'статус'
-        ws_res['L1'] = 'аккаунт'
-        ws_res['M1'] = 'id заказа'
-        ws_res['N1'] = 'ип'
-        ws_res['O1'] = 'цена'
-        ws_res['P1'] = 'sid'
-        ws_res['Z2'] = date.strftime('%d.%m')
-
-        ln = 1
-        for task in db_tasks:
-            ln += 1
-            ws_res[f'A{ln}'] = ln - 1
-            ws_res[f'B{ln}'] = task.product.ozon_article
-            ws_res[f'C{ln}'] = 1
-            ws_res[f'D{ln}'] = task.product.ozon_size
-            ws_res[f'E{ln}'] = task.ozon_keyword
-            ws_res[f'N{ln}'] = task.product.organization.title
-            ws_res[f'O{ln}'] = task.product.ozon_price
-            ws_res[f'P{ln}'] = task.id
-
-        result_bytes = io.BytesIO()
-        result_book.save(result_bytes)
-        result_bytes.seek(0)
-
-        fn = f'{Strings.alphanumeric(32)}.xlsx'
-        await Repository.s3_save(result_bytes.getvalue(), fn)
+        result_path = await run_in_process(build_plan_file, plan_tasks(db_tasks), date, output_format)
+
+        fn = Strings.alphanumeric(32) + PLAN_OUTPUT_FORMATS[output_format]
+        try:
+            await Repository.s3_save_file(result_path, fn)
+        finally:
+            os.remove(result_path)
 
         await Repository.save_records([
             {
@@ -802,39 +905,301 @@ async def generate_plan_xlsx_2(servers, date):
                         'result': fn,
                         'logs': '-',
                         'server_id': server.id,
+                        'job_id': job.id if job else None,
                     }
                 ]
             }
         ])
 
 
+PLAN_OUTPUT_FORMATS = {
+    'xlsx': '.xlsx',
+    'csv': '.csv.gz',
+    'parquet': '.parquet',
+}
+
+
+class SheetCell:
+
+    def __init__(self, sheet, row, column):
+        self.sheet = sheet
+        self.row = row
+        self.column = column
+
+    @property
+    def value(self):
+        return self.sheet.rows.get(self.row, {}).get(self.column)
+
+    @value.setter
+    def value(self, value):
+        self.sheet.rows.setdefault(self.row, {})[self.column] = value
+
+    @property
+    def fill(self):
+        return self.sheet.fills.get((self.row, self.column))
+
+    @fill.setter
+    def fill(self, fill):
+        self.sheet.fills[(self.row, self.column)] = fill
+
+
+class SheetBuffer:
+    # values of the sheet being filled, cells are set out of order until it is appended to a write-only book
+
+    def __init__(self, title):
+        self.title = title
+        self.rows = {}  # row -> {column: value}
+        self.fills = {}  # (row, column) -> fill
+
+    def __getitem__(self, coordinate):
+        column, row = coordinate_from_string(coordinate)
+        return SheetCell(self, row, column_index_from_string(column))
+
+    def __setitem__(self, coordinate, value):
+        self[coordinate].value = value
+
+    def cell(self, row, column, value=None):
+        cell = SheetCell(self, row, column)
+        if value is not None:
+            cell.value = value
+        return cell
+
+    @property
+    def max_row(self):
+        return max(self.rows, default=0)
+
+    def iter_rows(self, max_col):
+        for row in range(1, self.max_row + 1):
+            values = self.rows.get(row, {})
+            yield tuple(values.get(column) for column in range(1, max_col + 1))
+
+
+class StreamingBook:
+    # write-only workbook, openpyxl keeps appended rows in temp files instead of cell objects in memory
+
+    def __init__(self):
+        self.book = openpyxl.Workbook(write_only=True)
+
+    def write(self, sheet):
+        worksheet = self.book.create_sheet(sheet.title)
+
+        for row in range(1, sheet.max_row + 1):
+            values = sheet.rows.get(row, {})
+            line = []
+
+            for column in range(1, max(values, default=0) + 1):
+                value = values.get(column)
+                fill = sheet.fills.get((row, column))
+
+                if fill:
+                    value = WriteOnlyCell(worksheet, value)
+                    value.fill = fill
+
+                line.append(value)
+
+            worksheet.append(line)
+
+    def save(self):
+        file = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+        file.close()
+
+        try:
+            self.book.save(file.name)
+        except Exception:
+            os.remove(file.name)
+            raise
+
+        self.book = None
+        return file.name
+
+    def close(self):
+        # an unsaved write-only book still holds a temp file per sheet, openpyxl removes them only on save
+        if self.book is None:
+            return
+
+        book, self.book = self.book, None
+
+        try:
+            book.save(io.BytesIO())
+        except (WorkbookAlreadySaved, OSError):
+            # a failed save has already closed the sheets it got to
+            pass
+
+
+# cells are stored as text, 'types' keeps one code per value column so the workbook can be rebuilt with its types
+CELL_TYPES = {
+    's': str,
+    'i': int,
+    'f': float,
+    'b': lambda value: value == 'True',
+    't': datetime.datetime.fromisoformat,
+    'd': datetime.date.fromisoformat,
+}
+
+
+def cell_type(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return '-'
+    if isinstance(value, (bool, np.bool_)):
+        return 'b'
+    if isinstance(value, numbers.Integral):
+        return 'i'
+    if isinstance(value, numbers.Real):
+        return 'f'
+    if isinstance(value, datetime.datetime):
+        return 't'
+    if isinstance(value, datetime.date):
+        return 'd'
+    return 's'
+
+
+def cell_text(value, value_type):
+    if value_type == '-':
+        return None
+    if value_type in 'td':
+        return value.isoformat()
+    return str(value)
+
+
+class TableBook:
+    # csv/parquet alternative to StreamingBook, sheets are stacked into one table keyed by sheet title and row
+
+    def __init__(self, output_format):
+        self.output_format = output_format
+        self.frames = []
+        self.titles = collections.Counter()
+
+    def write(self, sheet):
+        if not sheet.rows:
+            return
+
+        # repeated titles are numbered the way openpyxl names duplicate sheets
+        title = f'{sheet.title}{self.titles[sheet.title]}' if self.titles[sheet.title] else sheet.title
+        self.titles[sheet.title] += 1
+
+        rows = sorted(sheet.rows)
+        columns = sorted(set().union(*sheet.rows.values()))
+
+        frame = pd.DataFrame(
+            [[sheet.rows[row].get(column) for column in columns] for row in rows],
+            index=rows,
+            columns=[get_column_letter(column) for column in columns],
+            dtype=object
+        )
+        frame.insert(0, 'sheet', title)
+        frame.insert(1, 'row', frame.index)
+
+        self.frames.append(frame)
+
+    def save(self):
+        frame = pd.concat(self.frames, ignore_index=True) if self.frames else pd.DataFrame(columns=['sheet', 'row'])
+        columns = sorted(frame.columns[2:], key=column_index_from_string)
+
+        types = [[cell_type(value) for value in line] for line in frame[columns].itertuples(index=False)]
+        texts = [[cell_text(value, value_type) for value, value_type in zip(line, line_types)]
+                 for line, line_types in zip(frame[columns].itertuples(index=False), types)]
+
+        frame = pd.concat([
+            frame[['sheet', 'row']],
+            pd.DataFrame({'types': [''.join(line_types) for line_types in types]}, dtype='string'),
+            pd.DataFrame(texts, columns=columns, dtype='string'),
+        ], axis=1)
+
+        file = tempfile.NamedTemporaryFile(suffix=PLAN_OUTPUT_FORMATS[self.output_format], delete=False)
+        file.close()
+
+        try:
+            if self.output_format == 'csv':
+                frame.to_csv(file.name, index=False, compression='gzip')
+            else:
+                frame.to_parquet(file.name, index=False)
+        except Exception:
+            os.remove(file.name)
+            raise
+
+        self.frames = None
+        return file.name
+
+    def close(self):
+        self.frames = None
+
+
+def plan_book(output_format):
+    return StreamingBook() if output_format == 'xlsx' else TableBook(output_format)
+
+
+def table_to_xlsx(content, file_name):
+    # rebuilds the workbook of a csv/parquet plan artifact when it is downloaded
+    if file_name.endswith(PLAN_OUTPUT_FORMATS['csv']):
+        frame = pd.read_csv(io.BytesIO(content), compression='gzip', dtype=str, keep_default_na=False)
+    else:
+        frame = pd.read_parquet(io.BytesIO(content))
+
+    frame = frame.astype(object).where(frame.notna(), None)
+    columns = [column_index_from_string(column) for column in frame.columns[3:]]
+
+    book = StreamingBook()
+    try:
+        for title, rows in frame.groupby('sheet', sort=False):
+            sheet = SheetBuffer(title)
+
+            for values in rows.itertuples(index=False):
+                for column, value_type, value in zip(columns, values[2], values[3:]):
+                    if value_type != '-':
+                        sheet.cell(row=int(values[1]), column=column, value=CELL_TYPES[value_type](value))
+
+            book.write(sheet)
+
+        path = book.save()
+    finally:
+        book.close()
+
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    finally:
+        os.remove(path)
+
 
 class Logs:
     title = None
-    book = openpyxl.Workbook()
+    book = None
     active = None
 
-    def __init__(self, title):
+    def __init__(self, title, output_format='xlsx'):
         self.title = title
-        self.active = self.book.active
-        self.active.title = "Logs"
+        self.book = plan_book(output_format)
+        self.active = SheetBuffer('Logs')
 
     def new(self, title):
-        self.active = self.book.create_sheet(title)
+        self.book.write(self.active)
+        self.active = SheetBuffer(title)
 
     def line(self, number, data):
         for i, d in enumerate(data):
-            self.active[f'{chr(65 + i)}{number}'] = d
+            self.active.cell(row=number, column=i + 1, value=d)
+
+    def save(self):
+        self.book.write(self.active)
+        self.active = None
+        return self.book.save()
+
+    def close(self):
+        self.book.close()
+        self.active = None
 
 
 class Result:
     title = None
-    book = openpyxl.Workbook()
+    book = None
     active = None
     date = None
 
-    def __init__(self, title: str, date: datetime.datetime = datetime.datetime.now()):
-        self.active = self.book.active
+    def __init__(self, title: str, date: datetime.datetime | None = None, output_format: str = 'xlsx'):
+        date = date or datetime.datetime.now()
+
+        self.book = plan_book(output_format)
+        self.active = SheetBuffer('Sheet')
         self.title = title
         self.date = date
 
@@ -854,28 +1219,29 @@ class Result:
         self.active['P1'] = 'sid'
         self.active['Z2'] = date.strftime('%d.%m')
 
-    async def tasks(self, tasks: list[OrdersOrderModel]):
+    def save(self):
+        self.book.write(self.active)
+        self.active = None
+        return self.book.save()
+
+    def close(self):
+        self.book.close()
+        self.active = None
+
+    def tasks(self, tasks: list[dict]):
         line = 1
         for task in tasks:
             line += 1
             self.active[f'A{line}'] = line - 1
-            self.active[f'B{line}'] = task.product.ozon_article
+            self.active[f'B{line}'] = task['article']
             self.active[f'C{line}'] = 1
-            self.active[f'D{line}'] = task.product.ozon_size if task.product.ozon_size else ''
-            self.active[f'E{line}'] = task.ozon_keyword
-            self.active[f'N{line}'] = task.product.organization.title
-            self.active[f'O{line}'] = task.product.ozon_price
-            self.active[f'P{line}'] = task.id
-
-    async def schedule(self, server, orgs, arts, k_format):
-
-        class ScheduleCell:
-            dt: datetime.datetime
-            org: str | None
+            self.active[f'D{line}'] = task['size'] if task['size'] else ''
+            self.active[f'E{line}'] = task['keyword']
+            self.active[f'N{line}'] = task['org']
+            self.active[f'O{line}'] = task['price']
+            self.active[f'P{line}'] = task['id']
 
-            def __init__(self, dt) -> None:
-                self.dt = dt
-                self.org = None
+    def schedule(self, server, orgs, arts, k_format):
 
         def calc_cells(dts, dte, osd):
             return int(
@@ -885,14 +1251,14 @@ class Result:
 
         tasks_amount = sum(orgs.values())
 
-        max_one_step_duration = server.schedule.time_max_min_per_step
-        min_one_step_duration = server.schedule.time_min_min_per_step
+        max_one_step_duration = server['schedule']['time_max_min_per_step']
+        min_one_step_duration = server['schedule']['time_min_min_per_step']
 
-        start_time = datetime.datetime.combine(self.date, server.schedule.time_start)
-        end_time = datetime.datetime.combine(self.date, server.schedule.time_end)
+        start_time = datetime.datetime.combine(self.date, server['schedule']['time_start'])
+        end_time = datetime.datetime.combine(self.date, server['schedule']['time_end'])
 
-        middle_point = datetime.datetime.combine(self.date, server.schedule.time_first_point)
-        last_point = datetime.datetime.combine(self.date, server.schedule.time_second_point)
+        middle_point = datetime.datetime.combine(self.date, server['schedule']['time_first_point'])
+        last_point = datetime.datetime.combine(self.date, server['schedule']['time_second_point'])
 
         # end time point
         one_step_duration = datetime.timedelta(minutes=max_one_step_duration)
@@ -930,855 +1296,942 @@ class Result:
         schedule = []
         current_time = start_time
         while current_time < end_time:
-            schedule.append(ScheduleCell(current_time))
+            schedule.append(current_time)
             current_time += one_step_duration
 
-        if schedule[-1].dt > end_time - one_step_duration:
+        if schedule[-1] > end_time - one_step_duration:
             schedule = schedule[:-1]
 
         time_length = (end_time - start_time).total_seconds()
 
         # Assigning organizations to schedule
+        cells_orgs = [None] * len(schedule)
+        next_free = list(range(len(schedule) + 1))  # cell index -> closest free cell index at or after it
+
+        def find_free(index):
+            root = index
+            while next_free[root] != root:
+                root = next_free[root]
+
+            while next_free[index] != root:
+                next_free[index], index = root, next_free[index]
+
+            return root
+
         for org in orgs:
 
             amount = orgs[org]
             single_length = time_length / amount
-            assigned_amount = 0
 
             for x in range(amount):
                 dt = start_time + datetime.timedelta(seconds=x * single_length)
 
                 # Find closest to dt free cell in schedule
-                closest_cell = None
-
-                for cell in schedule:
-                    if cell.dt >= dt and not cell.org:
-                        closest_cell = cell
-                        break
+                index = find_free(bisect.bisect_left(schedule, dt))
 
-                if closest_cell:
-                    assigned_amount += 1
-                    closest_cell.org = org
+                if index < len(schedule):
+                    cells_orgs[index] = org
+                    next_free[index] = index + 1
 
         # Writing schedule
-        used_dt = []
-        used_lines = []
+        org_cells = {}
+        for dt, org in zip(schedule, cells_orgs):
+            if org:
+                org_cells.setdefault(org, collections.deque()).append(dt)
 
+        art_lines = {}
+        for line, row in enumerate(self.active.iter_rows(max_col=14), start=1):
+            art_lines.setdefault((str(row[1]), str(row[13])), collections.deque()).append(line)
+
+        times = {}
         for org in arts:
-            m = max(arts[org].values())
-            for i in range(m):
-                for art in arts[org]:
-                    if arts[org][art] != 0:
-                        line = 1
-                        for row in self.active.rows:
-                            if str(row[1].value) == str(art) and str(row[13].value) == str(
-                                    org) and line not in used_lines:
-                                for cell in schedule:
-                                    if cell.org and cell.org == org and cell.dt not in used_dt:
-                                        used_dt.append(cell.dt)
-                                        row[10].value = cell.dt.strftime(k_format)
-                                        break
-                                used_lines.append(line)
-                                break
-                            line += 1
-                        arts[org][art] -= 1
+            cells = org_cells.get(org, collections.deque())
 
+            for i in range(max(arts[org].values())):
+                for art, art_amount in arts[org].items():
+                    lines = art_lines.get((str(art), str(org)))
 
-async def proc_0(org_accs, used_addrs):
-    new_org_accs = []
+                    if i < art_amount and lines:
+                        line = lines.popleft()
 
-    for i in range(0, len(org_accs)):
+                        if cells:
+                            times[line] = cells.popleft().strftime(k_format)
 
-        # K - amount of orders planned on account's address for today
-        K = used_addrs.count(org_accs[i]['address_id'])
-        org_accs[i]['K'] = K
+        for line, value in times.items():
+            self.active.cell(row=line, column=11, value=value)
 
-        # L = K + W
-        org_accs[i]['L'] = K + org_accs[i]['W']
 
-        # Check L
-        if org_accs[i]['L'] in range(org_accs[i]['contractor'].load_l_min,
-                                     org_accs[i]['contractor'].load_l_max + 1):
-            new_org_accs.append(org_accs[i])
+def is_int(value):
+    return isinstance(value, numbers.Integral)
 
-    return new_org_accs
 
+class AccountsScoring:
+    accs = None
+    order = None
+    scores = None
 
-async def proc_1(accs, settings):
-    maxH = max(acc['H'] for acc in accs)
-    maxH = 100 if maxH == 0 else maxH
+    def __init__(self, accs, used_addrs, settings):
+        self.accs = accs
+        self.settings = settings
+        self.order = np.arange(len(accs))
+        self.active = np.ones(len(accs), dtype=bool)
 
-    for acc in accs:
+        self.address_rows = {}
+        for row, acc in enumerate(accs):
+            self.address_rows.setdefault(acc['address_id'], []).append(row)
 
-        acc['X'] = ((maxH - acc['H']) / maxH) * 100
-        acc['Z'] = 0
-        acc['AB'] = acc['L']
-        acc['AD'] = settings.r4 - acc['T']
+        today = datetime.datetime.now().date()
 
-        if acc['M'] is not None:
+        self.K = np.array([used_addrs[acc['address_id']] for acc in accs], dtype=np.int64)
+        self.W = np.array([acc['W'] for acc in accs], dtype=np.int64)
+        self.H = np.array([acc['H'] for acc in accs], dtype=np.int64)
+        self.T = np.array([acc['T'] for acc in accs], dtype=np.int64)
+        self.M = np.array([acc['M'] is not None for acc in accs], dtype=bool)
+        self.l_min = np.array([acc['contractor']['load_l_min'] for acc in accs], dtype=np.int64)
+        self.l_max = np.array([acc['contractor']['load_l_max'] for acc in accs], dtype=np.int64)
 
-            if acc['H'] == 0:
-                acc['Z'] = settings.r2
+        # Z and AD do not depend on address usage
+        t = np.array([(today - acc['M']).days if acc['M'] is not None else 0 for acc in accs], dtype=np.int64)
 
-            else:
+        self.Z = np.where(
+            ~self.M, settings['r2'] + 10,
+            np.where(self.H == 0, settings['r2'], np.where(t > settings['r2'], settings['r2'] + t * settings['r3'], t))
+        ).astype(np.float64)
+        self.AD = np.where(self.T == 0, 0, settings['r4'] - self.T).astype(np.float64)
 
-                t = (datetime.datetime.now().date() - acc['M']).days
+        # scores are computed as floats, cells that came out of integers are logged as integers
+        self.Z_int = np.where(
+            ~self.M | (self.H == 0), is_int(settings['r2']),
+            (t <= settings['r2']) | (is_int(settings['r2']) and is_int(settings['r3']))
+        )
+        self.AD_int = (self.T == 0) | is_int(settings['r4'])
+
+        self.L = self.K + self.W
+        self.rows = self.order
+        self.ranking = self.order
+        self.scores = {}
+        self.integral = {}
+
+    def use_address(self, address_id):
+        rows = self.address_rows.get(address_id)
+
+        if rows:
+            self.K[rows] += 1
+            self.L[rows] += 1
+
+    def rank(self):
+        settings = self.settings
+
+        # L | K W
+        self.active &= (self.L >= self.l_min) & (self.L <= self.l_max)
+        rows = self.order[self.active[self.order]]
+
+        if len(rows) == 0:
+            self.order = rows
+            return []
+
+        L, H, Z, AD = self.L[rows], self.H[rows], self.Z[rows], self.AD[rows]
+
+        with np.errstate(divide='raise', invalid='raise'):
+            # X Z AB AD | H L T
+            maxH = H.max()
+            maxH = 100 if maxH == 0 else maxH
+
+            X = ((maxH - H) / maxH) * 100
+            AB = np.where(L == 0, 0, np.where(L >= settings['r4'], settings['r4'] - 1, L)).astype(np.float64)
+
+            # Y AA AC AE | X Z AB AD
+            maxX = X.max()
+            maxZ = settings['r2'] + 10 if not self.M[rows].all() else Z.max()
+
+            maxX = 100 if maxX == 0 else maxX
+            maxZ = 100 if maxZ == 0 else maxZ
+
+            Y = (X / maxX) * 100
+            AA = (Z / maxZ) * 100
+            AC = (AB / (settings['r4'] - 1)) * 100
+            AE = AD / settings['r4'] * 100
+
+            # AF | Y AA AC AE
+            AF = (
+                    (
+                            Y * settings['l2'] +
+                            AA * settings['l3'] +
+                            AC * settings['l4'] +
+                            AE * settings['l5']
+                    ) * 100 /
+                    (
+                            Y.max() * settings['l2'] +
+                            AA.max() * settings['l3'] +
+                            AC.max() * settings['l4'] +
+                            AE.max() * settings['l5']
+                    )
+            )
 
-                if t > settings.r2:
-                    acc['Z'] = settings.r2 + t * settings.r3
+        self.rows = rows
+        self.ranking = np.argsort(-AF, kind='stable')
+        self.order = rows[self.ranking]
 
-                else:
-                    acc['Z'] = t
+        self.scores = {
+            'K': self.K[rows], 'L': L, 'X': X, 'Z': Z, 'AB': AB, 'AD': AD,
+            'Y': Y, 'AA': AA, 'AC': AC, 'AE': AE, 'AF': AF,
+        }
+        self.integral = {
+            'Z': self.Z_int[rows],
+            'AB': (L < settings['r4']) | (L == 0) | is_int(settings['r4']),
+            'AD': self.AD_int[rows],
+        }
 
-        else:
-            acc['Z'] = settings.r2 + 10
+        return [self.accs[row] for row in self.order.tolist()]
 
-        if acc['L'] == 0:
-            acc['AB'] = 0
+    def ranked_scores(self):
+        for position in self.ranking.tolist():
+            scores = {key: column[position].item() for key, column in self.scores.items()}
 
-        elif acc['L'] >= settings.r4:
-            acc['AB'] = settings.r4 - 1
+            for key, integral in self.integral.items():
+                if integral[position]:
+                    scores[key] = int(scores[key])
 
-        if acc['T'] == 0:
-            acc['AD'] = 0
+            yield self.accs[self.rows[position]], scores
 
-    return accs
 
+class UndoLog:
+    # changes made by a picker iteration, so a retry reverts them instead of copying the whole state
 
-async def proc_2(accs, settings):
-    maxX = max(acc['X'] for acc in accs)
-    maxZ = max(acc['Z'] for acc in accs)
+    def __init__(self):
+        self.changes = []
 
-    for acc in accs:
-        if not acc['M']:
-            maxZ = settings.r2 + 10
-            break
+    def append(self, values, value):
+        values.append(value)
+        self.changes.append((values, value))
 
-    maxX = 100 if maxX == 0 else maxX
-    maxZ = 100 if maxZ == 0 else maxZ
+    def count(self, counter, key):
+        counter[key] += 1
+        self.changes.append((counter, key))
 
-    for acc in accs:
-        acc['Y'] = (acc['X'] / maxX) * 100
-        acc['AA'] = (acc['Z'] / maxZ) * 100
-        acc['AC'] = (acc['AB'] / (settings.r4 - 1)) * 100
-        acc['AE'] = acc['AD'] / settings.r4 * 100
+    def rollback(self):
+        while self.changes:
+            values, key = self.changes.pop()
 
-    return accs
+            if isinstance(values, collections.Counter):
+                values[key] -= 1
+                if not values[key]:
+                    del values[key]
+            else:
+                values.pop()
 
+    def commit(self):
+        self.changes = []
 
-async def proc_3(accs, settings):
-    maxY = max(acc['Y'] for acc in accs)
-    maxAA = max(acc['AA'] for acc in accs)
-    maxAC = max(acc['AC'] for acc in accs)
-    maxAE = max(acc['AE'] for acc in accs)
 
-    for acc in accs:
-        acc['AF'] = (
-                (
-                        acc['Y'] * settings.l2 +
-                        acc['AA'] * settings.l3 +
-                        acc['AC'] * settings.l4 +
-                        acc['AE'] * settings.l5
-                ) * 100 /
-                (
-                        maxY * settings.l2 +
-                        maxAA * settings.l3 +
-                        maxAC * settings.l4 +
-                        maxAE * settings.l5
-                )
-        )
+class OrdersAggregates:
+    # order counters and dates for the picker, grouped once instead of querying df_orders per account
 
-    return accs
+    def __init__(self, df_orders):
+        active = df_orders[df_orders['dt_collected'].isnull()]
 
+        # by account
+        self.first_order = df_orders.groupby('account_id')['dt_ordered'].min().to_dict()
+        self.first_active_order = active.groupby('account_id')['dt_ordered'].min().to_dict()
+        self.account_active = active.groupby('account_id').size().to_dict()  # T
 
+        # by address
+        self.address_active = active.groupby('address_id').size().to_dict()  # W
+        self.address_active_accounts = active.groupby('address_id')['account_id'].nunique().to_dict()  # HH
 
+        # by account and organization
+        self.account_org = df_orders.groupby(['account_id', 'org']).size().to_dict()  # I
 
+        # by address and organization
+        self.address_org = df_orders.groupby(['address_id', 'org']).size().to_dict()  # H
+        self.address_org_last_order = df_orders.groupby(['address_id', 'org'])['dt_ordered'].max().to_dict()  # M
 
 
-async def generate_plan_main(servers, bad_accounts, date):
-    # Prepare data
-    bad_accounts = (
-        bad_accounts.replace('\n', '').replace(' ', '').split('\r')
-        if bad_accounts
-        else []
-    )
+# planning runs in the process pool, it gets plain values instead of ORM instances bound to a session
+def plan_settings(db_settings):
+    keys = ['r2', 'r3', 'r4', 'l2', 'l3', 'l4', 'l5', 'lo', 'al', 'k_format']
+    return {key: getattr(db_settings, key) for key in keys}
 
-    db_settings = await Repository.get_records(PickerSettingsModel)
-    db_settings = db_settings[0]
 
-    db_orders = await Repository.get_records(
-        OrdersOrderModel,
-        filters=[OrdersOrderModel.dt_ordered.isnot(None)],
-        select_related=[OrdersOrderModel.product, OrdersOrderModel.account],
-        deep_related=[
-            [OrdersOrderModel.product, ProductModel.organization]
+def plan_server(server):
+    schedule_keys = ['time_min_min_per_step', 'time_max_min_per_step', 'time_start', 'time_end', 'time_first_point',
+                     'time_second_point']
+    contractor_keys = ['load_percent', 'load_j_min', 'load_j_max', 'load_l_min', 'load_l_max', 'load_t_min',
+                       'load_t_max', 'load_i', 'load_m']
+
+    return {
+        'schedule': {key: getattr(server.schedule, key) for key in schedule_keys},
+        'contractors': [
+            {
+                'contractor_id': server_contractor.contractor.id,
+                'name': server_contractor.contractor.name,
+                **{key: getattr(server_contractor, key) for key in contractor_keys},
+            }
+            for server_contractor in server.contractors
         ],
-        joins=[ProductModel, OrganizationModel],
-    )
+    }
 
-    for order in db_orders:
-        if not order.account:
-            raise Exception(f'Не указан аккаунт у заказа #{order.id}')
 
-    df_orders = pd.DataFrame(
+def plan_tasks(db_tasks):
+    return [
         {
-            'account_id': order.account_id,
-            'address_id': order.account.address_id,
-            'org_id': order.product.org_id,
-            'org': order.product.organization.title,
-            'dt_ordered': order.dt_ordered,
-            'dt_delivered': order.dt_delivered,
-            'dt_collected': order.dt_collected,
+            'id': task.id,
+            'keyword': task.ozon_keyword,
+            'article': task.product.ozon_article,
+            'size': task.product.ozon_size,
+            'price': task.product.ozon_price,
+            'org': task.product.organization.title,
         }
-        for order in db_orders
-    )
+        for task in db_tasks
+    ]
 
-    settings_last_order = datetime.timedelta(days=db_settings.lo)
-    settings_account_life = datetime.timedelta(days=db_settings.al)
-    settings_now = datetime.datetime.now()
-    settings_now_date = datetime.date.today()
 
-    used_addresses = []
-    total_selected_accounts = []
+def plan_accounts(db_accounts):
+    return [
+        {
+            'id': account.id,
+            'number': account.number,
+            'name': account.name,
+            'is_active': account.is_active,
+            'reg_date': account.reg_date,
+            'address_id': account.address_id,
+            'address': account.address.address,
+            'district': account.address.district,
+            'contractor': account.address.contractor.name if account.address.contractor else None,
+            'contractor_id': account.address.contractor_id,
+            'address_is_active': account.address.is_active,
+        }
+        for account in db_accounts
+    ]
 
-    for server in servers:
 
-        ################################################################################################################
-        # DATA PREPARATION
-        ################################################################################################################
-        db_tasks = await Repository.get_records(
-            model=OrdersOrderModel,
-            filters=[OrdersOrderModel.status == 2, OrdersOrderModel.dt_planed == date],
-            filtration=[OrganizationModel.server_id == server.id],
-            select_related=[OrdersOrderModel.product],
-            deep_related=[
-                [OrdersOrderModel.product, ProductModel.organization]
-            ],
-            joins=[ProductModel, OrganizationModel],
-        )
+def pick_server_accounts(server, db_tasks, db_accounts, vips_with_values, accounts_with_arts, aggregates, db_settings,
+                         bad_accounts, used_addresses, selected_on_addresses, output_format='xlsx'):
+    logs = Logs(Strings.alphanumeric(32), output_format)
+    result = Result(Strings.alphanumeric(32), datetime.datetime.now(), output_format)
 
-        selected_accs, used_addrs, accs = [], used_addresses.copy(), []
-        selected_vips = []
-        used_accs = {c.contractor.name: [] for c in server.contractors}
+    # books of the run are released even if picking fails, saved files are left for upload
+    try:
+        return fill_server_plan(logs, result, server, db_tasks, db_accounts, vips_with_values, accounts_with_arts,
+                                aggregates, db_settings, bad_accounts, used_addresses, selected_on_addresses)
+    finally:
+        logs.close()
+        result.close()
 
-        db_vips = await Repository.get_records(
-            model=PickerServerClientModel,
-            select_related=[PickerServerClientModel.organization],
-            joins=[OrganizationModel],
-            filtration=[OrganizationModel.server_id == server.id]
-        )
 
-        vips = [c.organization.title for c in db_vips]
-        vips_with_values = {c.organization.title: c.load_i for c in db_vips}
+def fill_server_plan(logs, result, server, db_tasks, db_accounts, vips_with_values, accounts_with_arts, aggregates,
+                     db_settings, bad_accounts, used_addresses, selected_on_addresses):
+    settings_last_order = datetime.timedelta(days=db_settings['lo'])
+    settings_account_life = datetime.timedelta(days=db_settings['al'])
+    settings_now_date = datetime.date.today()
 
-        logs = Logs(Strings.alphanumeric(32))
-        result = Result(Strings.alphanumeric(32), settings_now)
+    ################################################################################################################
+    # DATA PREPARATION
+    ################################################################################################################
+    selected_accs, used_addrs, accs = [], used_addresses.copy(), []
+    selected_vips = []
+    used_accs = {c['name']: collections.Counter() for c in server['contractors']}
+    picks = UndoLog()
 
-        await result.tasks(db_tasks)
+    vips = list(vips_with_values)
 
-        names = [(order.product.organization.title, order.product.ozon_article) for order in db_tasks]
-        arts = {}
-        orgs = {}
+    result.tasks(db_tasks)
 
-        for org, art in names:
-            orgs[org] = orgs.get(org, 0) + 1
-            arts.setdefault(org, {})[art] = arts.get(org, {}).get(art, 0) + 1
+    names = [(task['org'], task['article']) for task in db_tasks]
+    arts = {}
+    orgs = {}
 
-        orgs = dict(sorted(orgs.items(), key=operator.itemgetter(1), reverse=True))
+    for org, art in names:
+        orgs[org] = orgs.get(org, 0) + 1
+        arts.setdefault(org, {})[art] = arts.get(org, {}).get(art, 0) + 1
 
-        orgs_with_arts = {}
-        for org, art in names:
-            if orgs_with_arts.get(org, None):
-                orgs_with_arts[org].append(art)
-            else:
-                orgs_with_arts[org] = [art]
+    orgs = dict(sorted(orgs.items(), key=operator.itemgetter(1), reverse=True))
 
-        await result.schedule(server, orgs, arts, db_settings.k_format)
-        try:
-            await result.schedule(server, orgs, arts, db_settings.k_format)
-        except Exception as e:
-            logs_bytes = io.BytesIO()
-            logs.book.save(logs_bytes)
-            logs_bytes.seek(0)
-            logs_filename, logs_filetype = await Repository.s3_autosave(logs_bytes.getvalue(),
-                                                                        Strings.alphanumeric(
-                                                                            32) + '.xlsx')
-            await Repository.save_records([
-                {
-                    'model': PickerHistoryModel, 'records':
-                    [
-                        {
-                            'logs': f'{logs_filename}.{logs_filetype}',
-                            'server_id': server.id,
-                        }
-                    ]
-                }
-            ])
+    orgs_with_arts = {}
+    for org, art in names:
+        if orgs_with_arts.get(org, None):
+            orgs_with_arts[org].append(art)
+        else:
+            orgs_with_arts[org] = [art]
+
+    result.schedule(server, orgs, arts, db_settings['k_format'])
+    try:
+        result.schedule(server, orgs, arts, db_settings['k_format'])
+    except Exception as e:
+        return None, logs.save(), used_addresses, selected_on_addresses
+
+    ################################################################################################################
+    # COMMON POOL
+    ################################################################################################################
+    logs.new('Общий пул')
+    logs.line(1, ['ID аккаунта', 'Номер', 'Имя', 'Статус аккаунта', 'ID адреса', 'Адрес', 'Район', 'Курьер',
+                  'Статус адреса', 'Исключен', 'T', 'W'])
+
+    for i, account in enumerate(db_accounts):
+        line = i + 2
+
+        logs.line(line,
+                  [account['id'], account['number'], account['name'],
+                   account['number'] in bad_accounts or account['is_active'], account['address_id'], account['address'], account['district'],
+                   account['contractor'], account['address_is_active']])
+
+        if account['number'] in bad_accounts:
+            logs.active[f'J{line}'] = 'Исключен, реестровый аккаунт'
             continue
 
-        ################################################################################################################
-        # COMMON POOL
-        ################################################################################################################
-        db_accounts = await Repository.get_records(
-            OrdersAccountModel,
-            filters=[OrdersAccountModel.server_id == server.id],
-            select_related=[OrdersAccountModel.address],
-        )
-
-
-        logs.new('Общий пул')
-        logs.line(1, ['ID аккаунта', 'Номер', 'Имя', 'Статус аккаунта', 'ID адреса', 'Адрес', 'Район', 'Курьер',
-                      'Статус адреса', 'Исключен', 'T', 'W'])
+        if not account['is_active']:
+            logs.active[f'J{line}'] = 'Исключен, аккаунт не активен'
+            continue
 
-        for i, account in enumerate(db_accounts):
-            line = i + 2
+        if not account['address_is_active']:
+            logs.active[f'J{line}'] = 'Исключен, адрес аккаунта не активен'
+            continue
 
-            logs.line(line,
-                      [account.id, account.number, account.name, account.number in bad_accounts or account.is_active,
-                       account.address.id, account.address.address, account.address.district,
-                       account.address.contractor, account.address.is_active])
+        # account last order
+        last_order = aggregates.first_active_order.get(account['id'])
 
-            if account.number in bad_accounts:
-                logs.active[f'J{line}'] = 'Исключен, реестровый аккаунт'
-                continue
+        if last_order and last_order + settings_last_order < settings_now_date:
+            logs.active[f'J{line}'] = \
+                f'Исключен, последний заказ на аккаунте позднее {settings_last_order.days} дней с текущей даты'
+            continue
 
-            if not account.is_active:
-                logs.active[f'J{line}'] = 'Исключен, аккаунт не активен'
-                continue
+        # account registration date
+        default_reg_date = aggregates.first_order.get(account['id'], settings_now_date)
+        reg_date = account['reg_date'] if account['reg_date'] else default_reg_date
 
-            if not account.address.is_active:
-                logs.active[f'J{line}'] = 'Исключен, адрес аккаунта не активен'
-                continue
+        if reg_date + settings_account_life < settings_now_date:
+            logs.active[
+                f'J{line}'] = f'Исключен, с даты регистрации аккаунта {reg_date} прошло ' \
+                              f'{(settings_now_date - reg_date).days} ' \
+                              f'дней с текущей даты (макс допустимо {settings_account_life.days} дней)'
+            continue
 
-            # account last order
-            query = (
-                df_orders
-                .query(f"account_id == {account.id} and dt_collected.isnull()")
-                .sort_values('dt_ordered', ascending=True)
-                .head(1)
-            )
+        # Contractor
+        contractor = next(
+            (
+                server_contractor for server_contractor in server['contractors']
+                if server_contractor['contractor_id'] == account['contractor_id']
+            ), None
+        )
 
-            last_order = query['dt_ordered'].iloc[0] if len(query.values) != 0 else None
+        if not contractor:
+            logs.active[f'J{line}'] = 'Исключен, курьер адреса аккаунта отсутствует на сервере'
+            continue
 
-            if last_order and last_order + settings_last_order < settings_now_date:
-                logs.active[f'J{line}'] = \
-                    f'Исключен, последний заказ на аккаунте позднее {settings_last_order.days} дней с текущей даты'
-                continue
+        # T
+        T = aggregates.account_active.get(account['id'], 0)
 
-            # account registration date
-            query = (
-                df_orders
-                .query(f"account_id == {account.id}")
-                .sort_values('dt_ordered', ascending=True)
-                .head(1)
-            )
+        if T not in range(contractor['load_t_min'], contractor['load_t_max'] + 1):
+            logs.active[f'J{line}'] = 'Исключен, выход за допустимый интервал кол-ва активных заказов на аккаунте'
+            continue
 
-            default_reg_date = query['dt_ordered'].iloc[0] if len(query.values) != 0 else settings_now_date
-            reg_date = account.reg_date if account.reg_date else default_reg_date
+        # W
+        W = aggregates.address_active.get(account['address_id'], 0)
 
-            if reg_date + settings_account_life < settings_now_date:
-                logs.active[
-                    f'J{line}'] = f'Исключен, с даты регистрации аккаунта {reg_date} прошло ' \
-                                  f'{(settings_now_date - reg_date).days} ' \
-                                  f'дней с текущей даты (макс допустимо {settings_account_life.days} дней)'
-                continue
+        accs.append({
+            'account_id': account['id'],
+            'address_id': account['address_id'],
+            'number': account['number'],
+            'address': account['address'],
+            'contractor': contractor,
+            'district': account['district'],
 
-            # Contractor
-            contractor = next(
-                (
-                    server_contractor for server_contractor in server.contractors
-                    if server_contractor.contractor.id == account.address.contractor_id
-                ), None
-            )
+            'T': T,  # amount of active orders on account
+            'W': W,  # amount of active orders on account's address
+        })
 
-            if not contractor:
-                logs.active[f'J{line}'] = 'Исключен, курьер адреса аккаунта отсутствует на сервере'
-                continue
+        logs.active[f'J{line}'] = 'Не исключен'
+        logs.active[f'K{line}'] = T
+        logs.active[f'L{line}'] = W
 
-            # T
-            T = (df_orders.query(f'account_id == {account.id} and dt_collected.isnull()').shape[0])
+    ################################################################################################################
+    # ACCOUNTS PICKER
+    ################################################################################################################
 
-            if T not in range(contractor.load_t_min, contractor.load_t_max + 1):
-                logs.active[f'J{line}'] = 'Исключен, выход за допустимый интервал кол-ва активных заказов на аккаунте'
-                continue
+    for org in orgs:
+        ITER_NUMBER = 0
+        ITER_SUCCESS = False
 
-            # W
-            W = (df_orders.query(f'address_id == {account.address_id} and dt_collected.isnull()').shape[0])
+        I_ADD = 0
+        amount = orgs[org]
 
-            accs.append({
-                'account_id': account.id,
-                'address_id': account.address_id,
-                'number': account.number,
-                'address': account.address.address,
-                'contractor': contractor,
-                'district': account.address.district,
+        cs_tmp = sorted(server['contractors'], key=lambda x: x['load_percent'], reverse=True)
+        contractors = []
+        remaining = amount
 
-                'T': T,  # amount of active orders on account
-                'W': W,  # amount of active orders on account's address
-            })
+        for c_tmp in cs_tmp[:-1]:
 
-            logs.active[f'J{line}'] = 'Не исключен'
-            logs.active[f'K{line}'] = T
-            logs.active[f'L{line}'] = W
+            cmax = round(amount * c_tmp['load_percent'])
 
-        ################################################################################################################
-        # ACCOUNTS PICKER
-        ################################################################################################################
+            if cmax >= remaining:
+                cmax = remaining
+                remaining = 0
 
-        for org in orgs:
-            ITER_NUMBER = 0
-            ITER_SUCCESS = False
+            elif cmax < remaining:
+                remaining -= cmax
 
-            I_ADD = 0
-            amount = orgs[org]
+            contractors.append({
+                'name': c_tmp['name'],
+                'usages': [],
+                'max': cmax
+            })
 
-            cs_tmp = sorted(server.contractors, key=lambda x: x.load_percent, reverse=True)
-            contractors = []
-            remaining = amount
+        contractors.append({
+            'name': cs_tmp[-1]['name'],
+            'usages': [],
+            'max': remaining
+        })
+
+        org_accounts_with_arts = accounts_with_arts if org in vips else {}
+
+        while not ITER_SUCCESS:
+
+            ITER_NUMBER += 1
+
+            for c in contractors:
+                c['usages'] = []
+
+            org_used_accs, org_used_addr, org_accs = [], set(), []
+            arts_on_accs = {}
+
+            # drop picks of the previous unsuccessful iteration
+            picks.rollback()
+
+            # H M
+            logs.new(org)
+            line = 1
+            logs.active[f'A{line}'] = 'ID аккаунта'
+            logs.active[f'B{line}'] = 'Номер'
+            logs.active[f'C{line}'] = 'ID адреса'
+            logs.active[f'D{line}'] = 'Адрес'
+            logs.active[f'E{line}'] = 'Курьер'
+            logs.active[f'F{line}'] = 'Район'
+            logs.active[f'G{line}'] = 'Организация'
+            logs.active[f'H{line}'] = 'Исключен'
+            logs.active[f'I{line}'] = 'T'
+            logs.active[f'J{line}'] = 'W'
+            logs.active[f'K{line}'] = 'I'
+            logs.active[f'L{line}'] = 'M'
+            logs.active[f'M{line}'] = 'H'
+            logs.active[f'N{line}'] = 'K'
+            logs.active[f'O{line}'] = 'L'
+            logs.active[f'P{line}'] = 'X'
+            logs.active[f'Q{line}'] = 'Z'
+            logs.active[f'R{line}'] = 'AB'
+            logs.active[f'S{line}'] = 'AD'
+            logs.active[f'T{line}'] = 'Y'
+            logs.active[f'U{line}'] = 'AA'
+            logs.active[f'V{line}'] = 'AC'
+            logs.active[f'W{line}'] = 'AE'
+            logs.active[f'X{line}'] = 'AF (Итоговый)'
+            logs.active[f'Y{line}'] = 'Выбран'
+
+            for acc in accs:
+
+                line += 1
+
+                logs.active[f'A{line}'] = acc['account_id']
+                logs.active[f'B{line}'] = acc['number']
+                logs.active[f'C{line}'] = acc['address_id']
+                logs.active[f'D{line}'] = acc['address']
+                logs.active[f'E{line}'] = acc['contractor']['name']
+                logs.active[f'F{line}'] = acc['district']
+                logs.active[f'G{line}'] = org
+                logs.active[f'I{line}'] = acc['T']
+                logs.active[f'J{line}'] = acc['W']
+
+                I = aggregates.account_org.get((acc['account_id'], org), 0)
+                logs.active[f'K{line}'] = I
+
+                if org not in vips:
+                    if I != 0:
+                        logs.active[f'H{line}'] = 'Исключен, ИП уже заказывал на этот аккаунт'
+                        continue
+                else:
+                    if I >= vips_with_values[org]:
+                        logs.active[
+                            f'H{line}'] = f'Исключен, ИП заказывал на этот аккаунт {I} раз. макс {vips_with_values[org]}'
+                        continue
 
-            for c_tmp in cs_tmp[:-1]:
+                M = aggregates.address_org_last_order.get((acc['address_id'], org))
 
-                cmax = round(amount * c_tmp.load_percent)
+                if M:
+                    logs.active[f'L{line}'] = M.strftime('%d.%m.%Y')
+                else:
+                    logs.active[f'L{line}'] = 'Не найдено'
 
-                if cmax >= remaining:
-                    cmax = remaining
-                    remaining = 0
+                if M and M > acc['contractor']['load_m']:
+                    logs.active[f'H{line}'] = 'Исключен, дата последнего заказа вне допустимого интервала'
+                    continue
 
-                elif cmax < remaining:
-                    remaining -= cmax
+                H = aggregates.address_org.get((acc['address_id'], org), 0)
 
-                contractors.append({
-                    'name': c_tmp.contractor.name,
-                    'usages': [],
-                    'max': cmax
+                logs.active[f'M{line}'] = H
+                org_accs.append({
+                    'org': org,
+                    **acc,
+                    'I': I,
+                    'H': H,  # amount of all orders of org on address of account
+                    'M': M,  # date of the last purchase of org on account's address
+                    'logs': line,
                 })
 
-            contractors.append({
-                'name': cs_tmp[-1].contractor.name,
-                'usages': [],
-                'max': remaining
-            })
+                logs.active[f'H{line}'] = 'Не исключен'
 
-            org_accounts_with_arts = {}
-
-            if org in vips:
-                db_client_orders = await Repository.get_records(
-                    OrdersOrderModel,
-                    filters=[OrdersOrderModel.dt_ordered.isnot(None)],
-                    select_related=[OrdersOrderModel.product],
-                    deep_related=[
-                        [OrdersOrderModel.product, ProductModel.organization]
-                    ],
-                    joins=[ProductModel, OrganizationModel],
-                )
+            scoring = AccountsScoring(org_accs, used_addrs, db_settings)
 
-                for oo in db_client_orders:
-                    acc_id_s = str(oo.account_id)
-                    if org_accounts_with_arts.get(acc_id_s):
-                        org_accounts_with_arts[acc_id_s].append(oo.product.ozon_article)
-                    else:
-                        org_accounts_with_arts[acc_id_s] = [oo.product.ozon_article]
-
-            while not ITER_SUCCESS:
-
-                ITER_NUMBER += 1
-
-                for c in contractors:
-                    c['usages'] = []
-
-                org_used_accs, org_used_addr, org_accs = [], [], []
-                arts_on_accs = {}
-
-                iter_used_addrs = copy.deepcopy(used_addrs)
-                iter_used_accs = copy.deepcopy(used_accs)
-                iter_selected_accs = copy.deepcopy(selected_accs)
-                iter_total_selected_accounts = copy.deepcopy(total_selected_accounts)
-                iter_selected_vips = copy.deepcopy(selected_vips)
-
-                # H M
-                logs.new(org)
-                line = 1
-                logs.active[f'A{line}'] = 'ID аккаунта'
-                logs.active[f'B{line}'] = 'Номер'
-                logs.active[f'C{line}'] = 'ID адреса'
-                logs.active[f'D{line}'] = 'Адрес'
-                logs.active[f'E{line}'] = 'Курьер'
-                logs.active[f'F{line}'] = 'Район'
-                logs.active[f'G{line}'] = 'Организация'
-                logs.active[f'H{line}'] = 'Исключен'
-                logs.active[f'I{line}'] = 'T'
-                logs.active[f'J{line}'] = 'W'
-                logs.active[f'K{line}'] = 'I'
-                logs.active[f'L{line}'] = 'M'
-                logs.active[f'M{line}'] = 'H'
-                logs.active[f'N{line}'] = 'K'
-                logs.active[f'O{line}'] = 'L'
-                logs.active[f'P{line}'] = 'X'
-                logs.active[f'Q{line}'] = 'Z'
-                logs.active[f'R{line}'] = 'AB'
-                logs.active[f'S{line}'] = 'AD'
-                logs.active[f'T{line}'] = 'Y'
-                logs.active[f'U{line}'] = 'AA'
-                logs.active[f'V{line}'] = 'AC'
-                logs.active[f'W{line}'] = 'AE'
-                logs.active[f'X{line}'] = 'AF (Итоговый)'
-                logs.active[f'Y{line}'] = 'Выбран'
-
-                for acc in accs:
-
-                    line += 1
-
-                    logs.active[f'A{line}'] = acc['account_id']
-                    logs.active[f'B{line}'] = acc['number']
-                    logs.active[f'C{line}'] = acc['address_id']
-                    logs.active[f'D{line}'] = acc['address']
-                    logs.active[f'E{line}'] = acc['contractor'].contractor.name
-                    logs.active[f'F{line}'] = acc['district']
-                    logs.active[f'G{line}'] = org
-                    logs.active[f'I{line}'] = acc['T']
-                    logs.active[f'J{line}'] = acc['W']
-
-                    I = (df_orders.query(f"account_id == {acc['account_id']} and org == '{org}'").shape[0])
-                    logs.active[f'K{line}'] = I
-
-                    if org not in vips:
-                        if I != 0:
-                            logs.active[f'H{line}'] = 'Исключен, ИП уже заказывал на этот аккаунт'
-                            continue
-                    else:
-                        if I >= vips_with_values[org]:
-                            logs.active[
-                                f'H{line}'] = f'Исключен, ИП заказывал на этот аккаунт {I} раз. макс {vips_with_values[org]}'
-                            continue
+            for i in range(0, amount):
 
-                    query = (
-                        df_orders
-                        .query(f"address_id == {acc['address_id']} and org == '{org}'")
-                        .sort_values('dt_ordered', ascending=False)
-                        .head(1)
-                    )
+                ACC_PICKED_FLAG = False
+                org_accs = scoring.rank()  # L K X Z AB AD Y AA AC AE AF
 
-                    M = query['dt_ordered'].iloc[0] if len(query.values) != 0 else None
+                if not org_accs:
+                    break
 
-                    if M:
-                        logs.active[f'L{line}'] = M.strftime('%d.%m.%Y')
-                    else:
-                        logs.active[f'L{line}'] = 'Не найдено'
+                if i == 0:
+                    for oa, score in scoring.ranked_scores():
+                        logs.active[f'N{oa["logs"]}'] = score['K']
+                        logs.active[f'O{oa["logs"]}'] = score['L']
+                        logs.active[f'P{oa["logs"]}'] = score['X']
+                        logs.active[f'Q{oa["logs"]}'] = score['Z']
+                        logs.active[f'R{oa["logs"]}'] = score['AB']
+                        logs.active[f'S{oa["logs"]}'] = score['AD']
+                        logs.active[f'T{oa["logs"]}'] = score['Y']
+                        logs.active[f'U{oa["logs"]}'] = score['AA']
+                        logs.active[f'V{oa["logs"]}'] = score['AC']
+                        logs.active[f'W{oa["logs"]}'] = score['AE']
+                        logs.active[f'X{oa["logs"]}'] = score['AF']
+
+                for org_acc in org_accs:
+
+                    if org in vips:
+
+                        I1 = 0
+                        if org_accounts_with_arts.get(str(org_acc['account_id'])):
+                            for acc_arts in org_accounts_with_arts[str(org_acc['account_id'])]:
+                                if str(acc_arts) == str(orgs_with_arts[org][i]):
+                                    I1 += 1
+
+                        I2 = 0
+                        if arts_on_accs.get(str(org_acc['account_id'])):
+                            for T_ART in arts_on_accs[str(org_acc['account_id'])]:
+                                if T_ART == orgs_with_arts[org][i]:
+                                    I2 += 1
+
+                        co = len(arts_on_accs.get(str(org_acc['account_id']), []))
+
+                        if (I1 + I2) != 0 or (org_acc['I'] + co) >= vips_with_values[org]:
+                            continue
 
-                    if M and M > acc['contractor'].load_m:
-                        logs.active[f'H{line}'] = 'Исключен, дата последнего заказа вне допустимого интервала'
+                    if org_acc['address_id'] in org_used_addr:
                         continue
 
-                    H = (df_orders.query(f"address_id == {acc['address_id']} and org == '{org}'").shape[0])
-
-                    logs.active[f'M{line}'] = H
-                    org_accs.append({
-                        'org': org,
-                        **acc,
-                        'I': I,
-                        'H': H,  # amount of all orders of org on address of account
-                        'M': M,  # date of the last purchase of org on account's address
-                        'logs': line,
-                    })
-
-                    logs.active[f'H{line}'] = 'Не исключен'
+                    # J
+                    for contractor in contractors:
+                        if (len(contractor['usages']) != contractor['max'] and
+                                org_acc['contractor']['name'] == contractor['name']):
 
-                for i in range(0, amount):
+                            HH = aggregates.address_active_accounts.get(org_acc['address_id'], 0)
 
-                    ACC_PICKED_FLAG = False
-                    org_accs = await proc_0(org_accs, iter_used_addrs)  # L | K W
+                            # unique accounts already selected on the address
+                            JJ = len(selected_on_addresses.get(org_acc['address_id'], ()))
 
-                    if not org_accs:
-                        break
+                            II = HH + JJ - I_ADD  # кол-во аккаунтов с активными заказами на адресе аккаунта
 
-                    org_accs = await proc_1(org_accs, db_settings)  # X Z AB AD   | H L T
-                    org_accs = await proc_2(org_accs, db_settings)  # Y AA AC AE  | X Z AB AD
-                    org_accs = await proc_3(org_accs, db_settings)  # AF          | Y AA AC AE
-
-                    org_accs = sorted(org_accs, key=lambda x: x['AF'], reverse=True)
-
-                    if i == 0:
-                        for oa in org_accs:
-                            logs.active[f'N{oa["logs"]}'] = oa['K']
-                            logs.active[f'O{oa["logs"]}'] = oa['L']
-                            logs.active[f'P{oa["logs"]}'] = oa['X']
-                            logs.active[f'Q{oa["logs"]}'] = oa['Z']
-                            logs.active[f'R{oa["logs"]}'] = oa['AB']
-                            logs.active[f'S{oa["logs"]}'] = oa['AD']
-                            logs.active[f'T{oa["logs"]}'] = oa['Y']
-                            logs.active[f'U{oa["logs"]}'] = oa['AA']
-                            logs.active[f'V{oa["logs"]}'] = oa['AC']
-                            logs.active[f'W{oa["logs"]}'] = oa['AE']
-                            logs.active[f'X{oa["logs"]}'] = oa['AF']
-
-                    for org_acc in org_accs:
-
-                        if org in vips:
-
-                            I1 = 0
-                            if org_accounts_with_arts.get(str(org_acc['account_id'])):
-                                for acc_arts in org_accounts_with_arts[str(org_acc['account_id'])]:
-                                    if str(acc_arts) == str(orgs_with_arts[org][i]):
-                                        I1 += 1
-
-                            I2 = 0
-                            if arts_on_accs.get(str(org_acc['account_id'])):
-                                for T_ART in arts_on_accs[str(org_acc['account_id'])]:
-                                    if T_ART == orgs_with_arts[org][i]:
-                                        I2 += 1
-
-                            co = 0
-                            for acc_id in arts_on_accs:
-                                if acc_id == str(org_acc['account_id']):
-                                    co += len(arts_on_accs[acc_id])
-
-                            if (I1 + I2) != 0 or (org_acc['I'] + co) >= vips_with_values[org]:
+                            if II >= org_acc['contractor']['load_i'] and org_acc['T'] == 0:
                                 continue
 
-                        if org_acc['address_id'] in org_used_addr:
-                            continue
+                            J = used_accs[org_acc['contractor']['name']][org_acc['account_id']]
 
-                        # J
-                        for contractor in contractors:
-                            if (len(contractor['usages']) != contractor['max'] and
-                                    org_acc['contractor'].contractor.name == contractor['name']):
+                            if J in range(org_acc['contractor']['load_j_min'], org_acc['contractor']['load_j_max'] + 1):
 
-                                HH = (
-                                    df_orders.query(
-                                        f'address_id == {org_acc["address_id"]} and dt_collected.isnull()').loc[
-                                    :,
-                                    'account_id'].unique().shape[0])
+                                # globals
+                                picks.count(used_addrs, org_acc['address_id'])
+                                scoring.use_address(org_acc['address_id'])
+                                picks.count(used_accs[org_acc['contractor']['name']], org_acc['account_id'])
+                                picks.append(selected_accs, org_acc)
+                                picks.count(
+                                    selected_on_addresses.setdefault(org_acc['address_id'], collections.Counter()),
+                                    org_acc['account_id']
+                                )
 
-                                aa_accs = []
+                                # local iter
+                                org_acc['J'] = J
+                                contractor['usages'].append(org_acc['account_id'])
+                                org_used_addr.add(org_acc['address_id'])
 
-                                JJ = 0
-                                for aacc in iter_total_selected_accounts:
-                                    if aacc['address_id'] == org_acc['address_id'] and \
-                                            aacc['account_id'] not in aa_accs:
-                                        aa_accs.append(aacc['account_id'])
-                                        JJ += 1
+                                if org in vips:
 
-                                II = HH + JJ - I_ADD  # кол-во аккаунтов с активными заказами на адресе аккаунта
+                                    picks.append(selected_vips, (orgs_with_arts[org][i], org_acc))
+                                    if arts_on_accs.get(str(org_acc['account_id'])):
+                                        arts_on_accs[str(org_acc['account_id'])].append(orgs_with_arts[org][i])
+                                    else:
+                                        arts_on_accs[str(org_acc['account_id'])] = [orgs_with_arts[org][i]]
 
-                                if II >= org_acc['contractor'].load_i and org_acc['T'] == 0:
-                                    continue
+                                # cell painting
+                                logs.active[f'Y{org_acc["logs"]}'] = 'Выбран'
+                                fill = PatternFill(patternType='solid', fgColor='FF00FF00')
+                                logs.active[f'D{org_acc["logs"]}'].fill = fill
 
-                                J = iter_used_accs[org_acc['contractor'].contractor.name].count(org_acc['account_id'])
+                                ACC_PICKED_FLAG = True
 
-                                if J in range(org_acc['contractor'].load_j_min, org_acc['contractor'].load_j_max + 1):
+                                break
 
-                                    # globals
-                                    iter_used_addrs.append(org_acc['address_id'])
-                                    iter_used_accs[org_acc['contractor'].contractor.name].append(org_acc['account_id'])
-                                    iter_selected_accs.append(org_acc)
-                                    iter_total_selected_accounts.append(org_acc)
+                    if ACC_PICKED_FLAG:
+                        break
 
-                                    # local iter
-                                    org_acc['J'] = J
-                                    contractor['usages'].append(org_acc['account_id'])
-                                    org_used_addr.append(org_acc['address_id'])
+            s = sum([len(c['usages']) for c in contractors])
+            logs.active[f'AA1'] = f'Всего'
+            logs.active[f'AC1'] = f'из {amount}'
 
-                                    if org in vips:
+            for i in range(0, len(contractors)):
+                t = len(contractors[i]['usages'])
+                logs.active[f'AA{i + 2}'] = contractors[i]['name']
+                logs.active[f'AB{i + 2}'] = t
+                logs.active[f'AC{i + 2}'] = contractors[i]['max']
 
-                                        iter_selected_vips.append((orgs_with_arts[org][i], org_acc))
-                                        if arts_on_accs.get(str(org_acc['account_id'])):
-                                            arts_on_accs[str(org_acc['account_id'])].append(orgs_with_arts[org][i])
-                                        else:
-                                            arts_on_accs[str(org_acc['account_id'])] = [orgs_with_arts[org][i]]
+            logs.active[f'AB1'] = f'{s}'
 
-                                    # cell painting
-                                    logs.active[f'Y{org_acc["logs"]}'] = 'Выбран'
-                                    fill = PatternFill(patternType='solid', fgColor='FF00FF00')
-                                    logs.active[f'D{org_acc["logs"]}'].fill = fill
+            if s >= amount:
+                ITER_SUCCESS = True
 
-                                    ACC_PICKED_FLAG = True
+            else:
+                if ITER_NUMBER == 1:
 
-                                    break
+                    contractors = []
+                    remaining = amount
 
-                        if ACC_PICKED_FLAG:
-                            break
+                    for c_tmp in cs_tmp[:-1]:
 
-                s = sum([len(c['usages']) for c in contractors])
-                logs.active[f'AA1'] = f'Всего'
-                logs.active[f'AC1'] = f'из {amount}'
+                        cmax = round(amount * c_tmp['load_percent'])
 
-                for i in range(0, len(contractors)):
-                    t = len(contractors[i]['usages'])
-                    logs.active[f'AA{i + 2}'] = contractors[i]['name']
-                    logs.active[f'AB{i + 2}'] = t
-                    logs.active[f'AC{i + 2}'] = contractors[i]['max']
+                        if cmax >= remaining:
+                            cmax = remaining
+                            remaining = 0
 
-                logs.active[f'AB1'] = f'{s}'
+                        elif cmax < remaining:
+                            remaining -= cmax
 
-                if s >= amount:
-                    ITER_SUCCESS = True
+                        contractors.append({
+                            'name': c_tmp['name'],
+                            'usages': [],
+                            'max': cmax
+                        })
 
-                else:
-                    if ITER_NUMBER == 1:
+                    contractors.append({
+                        'name': cs_tmp[-1]['name'],
+                        'usages': [],
+                        'max': remaining
+                    })
 
-                        contractors = []
-                        remaining = amount
+                    I_ADD += 1
 
-                        for c_tmp in cs_tmp[:-1]:
+                if ITER_NUMBER == 2:
 
-                            cmax = round(amount * c_tmp.load_percent)
+                    tasks_not_completed = amount - sum([len(c['usages']) for c in contractors])
 
-                            if cmax >= remaining:
-                                cmax = remaining
-                                remaining = 0
+                    server_contractors_percents = {}
+                    for SC in server['contractors']:
+                        server_contractors_percents[SC['name']] = SC['load_percent']
 
-                            elif cmax < remaining:
-                                remaining -= cmax
+                    new_contractors = []
 
-                            contractors.append({
-                                'name': c_tmp.contractor.name,
+                    work_left = amount
+
+                    contractors_to_work = []
+                    for c in contractors:
+                        if len(c['usages']) < c['max']:
+                            new_contractors.append({
+                                'name': c['name'],
                                 'usages': [],
-                                'max': cmax
+                                'max': len(c['usages'])
                             })
 
-                        contractors.append({
-                            'name': cs_tmp[-1].contractor.name,
+                            work_left -= len(c['usages'])
+
+                        else:
+                            contractors_to_work.append(c)
+
+                    percents_sum = 0
+                    for c in contractors_to_work:
+                        percents_sum += server_contractors_percents[c['name']]
+
+                    remaining = work_left
+                    for c in contractors_to_work[:-1]:
+
+                        cmax = round(work_left * server_contractors_percents[c['name']] / percents_sum)
+
+                        if cmax >= remaining:
+                            cmax = remaining
+                            remaining = 0
+
+                        elif cmax < remaining:
+                            remaining -= cmax
+
+                        new_contractors.append({
+                            'name': c['name'],
+                            'usages': [],
+                            'max': cmax
+                        })
+
+                    if len(contractors_to_work) > 0:
+                        new_contractors.append({
+                            'name': contractors_to_work[-1]['name'],
                             'usages': [],
                             'max': remaining
                         })
 
-                        I_ADD += 1
+                    RL = 9
+                    RL2 = 4
+                    contractors = new_contractors.copy()
 
-                    if ITER_NUMBER == 2:
+                if ITER_NUMBER == 3:
+                    ITER_SUCCESS = True
 
-                        tasks_not_completed = amount - sum([len(c['usages']) for c in contractors])
+        picks.commit()
 
-                        server_contractors_percents = {}
-                        for SC in server.contractors:
-                            server_contractors_percents[SC.contractor.name] = SC.load_percent
+        s = 0
+        logs.active[f'AA1'] = f'Всего'
+        logs.active[f'AC1'] = f'из {amount}'
 
-                        new_contractors = []
+        for i in range(0, len(contractors)):
+            t = len(contractors[i]['usages'])
+            logs.active[f'AA{i + 2}'] = contractors[i]['name']
+            logs.active[f'AB{i + 2}'] = t
+            logs.active[f'AC{i + 2}'] = contractors[i]['max']
+            s += t
 
-                        work_left = amount
+        logs.active[f'AB1'] = f'{s}'
 
-                        contractors_to_work = []
-                        for c in contractors:
-                            if len(c['usages']) < c['max']:
-                                new_contractors.append({
-                                    'name': c['name'],
-                                    'usages': [],
-                                    'max': len(c['usages'])
-                                })
+    random.shuffle(selected_accs)
+    random.shuffle(selected_vips)
 
-                                work_left -= len(c['usages'])
+    for line in range(2, result.active.max_row + 1):
+        for acc in selected_accs:
+            if acc['org'] not in vips:
+                if acc['org'] == result.active[f'N{line}'].value and not acc.get('selected'):
+                    acc['selected'] = True
+                    result.active[f'G{line}'] = acc['address']
+                    result.active[f'L{line}'] = acc['number']
+                    break
 
-                            else:
-                                contractors_to_work.append(c)
+    for line in range(2, result.active.max_row + 1):
+        for art, acc in selected_vips:
 
-                        percents_sum = 0
-                        for c in contractors_to_work:
-                            percents_sum += server_contractors_percents[c['name']]
+            if str(acc['org']) == str(result.active[f'N{line}'].value) and not acc.get('selected') and str(
+                    art) == str(
+                    result.active[f'B{line}'].value):
+                acc['selected'] = True
+                result.active[f'G{line}'] = acc['address']
+                result.active[f'L{line}'] = acc['number']
+                break
 
-                        remaining = work_left
-                        for c in contractors_to_work[:-1]:
+    result.active[f'Z2'] = datetime.datetime.now().strftime('%d.%m')
 
-                            cmax = round(work_left * server_contractors_percents[c['name']] / percents_sum)
+    return result.save(), logs.save(), used_addrs.copy(), selected_on_addresses
 
-                            if cmax >= remaining:
-                                cmax = remaining
-                                remaining = 0
 
-                            elif cmax < remaining:
-                                remaining -= cmax
+async def generate_plan_main(servers, bad_accounts, date, output_format='xlsx', job=None):
+    # Prepare data
+    bad_accounts = (
+        bad_accounts.replace('\n', '').replace(' ', '').split('\r')
+        if bad_accounts
+        else []
+    )
 
-                            new_contractors.append({
-                                'name': c['name'],
-                                'usages': [],
-                                'max': cmax
-                            })
+    db_settings = await Repository.get_records(PickerSettingsModel)
+    db_settings = plan_settings(db_settings[0])
 
-                        if len(contractors_to_work) > 0:
-                            new_contractors.append({
-                                'name': contractors_to_work[-1]['name'],
-                                'usages': [],
-                                'max': remaining
-                            })
+    db_orders = await Repository.get_records(
+        OrdersOrderModel,
+        filters=[OrdersOrderModel.dt_ordered.isnot(None)],
+        select_related=[OrdersOrderModel.product, OrdersOrderModel.account],
+        deep_related=[
+            [OrdersOrderModel.product, ProductModel.organization]
+        ],
+        joins=[ProductModel, OrganizationModel],
+    )
 
-                        RL = 9
-                        RL2 = 4
-                        contractors = new_contractors.copy()
+    for order in db_orders:
+        if not order.account:
+            raise Exception(f'Не указан аккаунт у заказа #{order.id}')
 
-                    if ITER_NUMBER == 3:
-                        ITER_SUCCESS = True
+    df_orders = pd.DataFrame((
+        {
+            'account_id': order.account_id,
+            'address_id': order.account['address_id'],
+            'org_id': order.product.org_id,
+            'org': order.product.organization.title,
+            'dt_ordered': order.dt_ordered,
+            'dt_delivered': order.dt_delivered,
+            'dt_collected': order.dt_collected,
+        }
+        for order in db_orders
+    ), columns=['account_id', 'address_id', 'org_id', 'org', 'dt_ordered', 'dt_delivered', 'dt_collected'])
 
-            used_addrs = copy.deepcopy(iter_used_addrs)
-            used_accs = copy.deepcopy(iter_used_accs)
-            selected_accs = copy.deepcopy(iter_selected_accs)
-            total_selected_accounts = copy.deepcopy(iter_total_selected_accounts)
-            selected_vips = copy.deepcopy(iter_selected_vips)
+    aggregates = OrdersAggregates(df_orders)
 
-            s = 0
-            logs.active[f'AA1'] = f'Всего'
-            logs.active[f'AC1'] = f'из {amount}'
+    # Articles ordered on each account (used for vip organizations)
+    accounts_with_arts = {}
+    for order in db_orders:
+        accounts_with_arts.setdefault(str(order.account_id), []).append(order.product.ozon_article)
 
-            for i in range(0, len(contractors)):
-                t = len(contractors[i]['usages'])
-                logs.active[f'AA{i + 2}'] = contractors[i]['name']
-                logs.active[f'AB{i + 2}'] = t
-                logs.active[f'AC{i + 2}'] = contractors[i]['max']
-                s += t
+    used_addresses = collections.Counter()
+    selected_on_addresses = {}  # address id -> Counter of selected account ids
 
-            logs.active[f'AB1'] = f'{s}'
+    for server_number, server in enumerate(servers):
 
-        random.shuffle(selected_accs)
-        random.shuffle(selected_vips)
+        if job:
+            await job.progress(server_number * 100 / len(servers))
 
-        line = 1
-        for row in result.active.rows:
-            line += 1
-            for acc in selected_accs:
-                if acc['org'] not in vips:
-                    if acc['org'] == result.active[f'N{line}'].value and not acc.get('selected'):
-                        acc['selected'] = True
-                        result.active[f'G{line}'] = acc['address']
-                        result.active[f'L{line}'] = acc['number']
-                        break
+        db_tasks = await Repository.get_records(
+            model=OrdersOrderModel,
+            filters=[OrdersOrderModel.status == 2, OrdersOrderModel.dt_planed == date],
+            filtration=[OrganizationModel.server_id == server.id],
+            select_related=[OrdersOrderModel.product],
+            deep_related=[
+                [OrdersOrderModel.product, ProductModel.organization]
+            ],
+            joins=[ProductModel, OrganizationModel],
+        )
 
-        line = 1
-        for row in result.active.rows:
-            line += 1
-            for art, acc in selected_vips:
+        db_vips = await Repository.get_records(
+            model=PickerServerClientModel,
+            select_related=[PickerServerClientModel.organization],
+            joins=[OrganizationModel],
+            filtration=[OrganizationModel.server_id == server.id]
+        )
 
-                if str(acc['org']) == str(result.active[f'N{line}'].value) and not acc.get('selected') and str(
-                        art) == str(
-                        result.active[f'B{line}'].value):
-                    acc['selected'] = True
-                    result.active[f'G{line}'] = acc['address']
-                    result.active[f'L{line}'] = acc['number']
-                    break
+        db_accounts = await Repository.get_records(
+            OrdersAccountModel,
+            filters=[OrdersAccountModel.server_id == server.id],
+            select_related=[OrdersAccountModel.address],
+        )
 
-        result.active[f'Z2'] = datetime.datetime.now().strftime('%d.%m')
+        vips_with_values = {c.organization.title: c.load_i for c in db_vips}
 
-        result_bytes = io.BytesIO()
-        logs_bytes = io.BytesIO()
+        result_path, logs_path, used_addresses, selected_on_addresses = await run_in_process(
+            pick_server_accounts,
+            plan_server(server), plan_tasks(db_tasks), plan_accounts(db_accounts), vips_with_values, accounts_with_arts, aggregates, db_settings,
+            bad_accounts, used_addresses, selected_on_addresses, output_format
+        )
 
-        result.book.save(result_bytes)
-        logs.book.save(logs_bytes)
+        history_record = {
+            'server_id': server.id,
+            'job_id': job.id if job else None,
+        }
 
-        result_bytes.seek(0)
-        logs_bytes.seek(0)
+        try:
+            if result_path is not None:
+                history_record['result'] = Strings.alphanumeric(32) + PLAN_OUTPUT_FORMATS[output_format]
+                await Repository.s3_save_file(result_path, history_record['result'])
 
-        result_filename, result_filetype = await Repository.s3_autosave(result_bytes.getvalue(),
-                                                                        Strings.alphanumeric(32) + '.xlsx')
-        logs_filename, logs_filetype = await Repository.s3_autosave(logs_bytes.getvalue(),
-                                                                    Strings.alphanumeric(32) + '.xlsx')
+            history_record['logs'] = Strings.alphanumeric(32) + PLAN_OUTPUT_FORMATS[output_format]
+            await Repository.s3_save_file(logs_path, history_record['logs'])
 
-        await Repository.save_records([
-            {
-                'model': PickerHistoryModel, 'records':
-                [
-                    {
-                        'result': f'{result_filename}.{result_filetype}',
-                        'logs': f'{logs_filename}.{logs_filetype}',
-                        'server_id': server.id,
-                    }
-                ]
-            }
-        ])
+        finally:
+            for path in (result_path, logs_path):
+                if path is not None:
+                    os.remove(path)
 
-        used_addresses = used_addrs.copy()
+        await Repository.save_records([{'model': PickerHistoryModel, 'records': [history_record]}])
@@ -27,7 +27,7 @@ class ProductModel(Base):
 
     # FK
     org_id: Mapped[int] = mapped_column(
-        ForeignKey('organization.id', ondelete='CASCADE', onupdate='CASCADE')
+        ForeignKey('organization.id', ondelete='CASCADE', onupdate='CASCADE'), index=True
     )
 
     # Relationships
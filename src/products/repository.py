@@ -1,7 +1,7 @@
 from sqlalchemy import select, and_
 from sqlalchemy.orm import selectinload, joinedload
 
-from database import async_session_factory
+from database import session_scope
 from products.models import ProductModel, ReviewModel, ReviewMediaModel
 from products.schemas import ProductCreateSchema, ProductSizeCreateSchema, ReviewCreateSchema
 
@@ -11,49 +11,41 @@ class ReviewsRepository:
     @classmethod
     async def create_review(cls, review_schema: ReviewCreateSchema, filenames: list):
 
-        try:
-            async with async_session_factory() as session:
+        async with session_scope() as session:
 
-                # Add review
-                review = ReviewModel(**review_schema.model_dump(), status=1)
-                session.add(review)
-                await session.flush()
+            # Add review
+            review = ReviewModel(**review_schema.model_dump(), status=1)
+            session.add(review)
+            await session.flush()
 
-                # Add review media
-                for filename in filenames:
-                    session.add(ReviewMediaModel(
-                        review_id=review.id,
-                        media=filename)
-                    )
-
-                await session.commit()
+            # Add review media
+            for filename in filenames:
+                session.add(ReviewMediaModel(
+                    review_id=review.id,
+                    media=filename)
+                )
 
-        finally:
-            await session.close()
+            await session.commit()
 
     @classmethod
     async def get_owned_by_org_id(cls, org_id: int) -> list[ReviewModel] | None:
 
-        try:
-
-            async with async_session_factory() as session:
+        async with session_scope() as session:
 
-                query = (
-                    select(ReviewModel)
-                    .options(
-                        selectinload(ReviewModel.media),
-                        selectinload(ReviewModel.product),
-                    )
-
-                    .join(ProductModel)
-                    .filter(ProductModel.org_id == org_id)
-                    .filter(ProductModel.status != 3)
+            query = (
+                select(ReviewModel)
+                .options(
+                    selectinload(ReviewModel.media),
+                    selectinload(ReviewModel.product),
                 )
 
-                db_response = await session.execute(query)
-                reviews = db_response.unique().scalars().all()
+                .join(ProductModel)
+                .filter(ProductModel.org_id == org_id)
+                .filter(ProductModel.status != 3)
+            )
+
+            db_response = await session.execute(query)
+            reviews = db_response.unique().scalars().all()
 
-                return reviews
+            return reviews
 
-        finally:
-            await session.close()
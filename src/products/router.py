@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 from typing import Annotated, List
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
@@ -6,8 +7,7 @@ from sqlalchemy import func
 from admin.models import CrmSettingsModel
 from auth.models import UserSessionModel
 from auth.router import authed
-from database import Repository
-from gutils import Strings
+from database import Repository, release_request_connection
 from orgs.models import OrganizationModel
 
 from orgs.router import check_access
@@ -43,7 +43,9 @@ async def create_product(data: Annotated[ProductPOSTSchema, Depends()], session:
     cookies = crm_settings[0].parser_cookies
     useragent = crm_settings[0].parser_useragent
 
-    result = parse_ozon_card(data.ozon_url, cookies, useragent)
+    # the card is fetched without holding the request's connection and off the event loop
+    await release_request_connection()
+    result = await asyncio.to_thread(parse_ozon_card, data.ozon_url, cookies, useragent)
 
     product_check = await Repository.get_records(
         ProductModel,
@@ -63,7 +65,7 @@ async def create_product(data: Annotated[ProductPOSTSchema, Depends()], session:
         if product.organization.id == organization.id and organization.is_competitor:
             raise HTTPException(status_code=400, detail=string_products_product_already_exists)
 
-    filename = Strings.alphanumeric(32) if result['image'] else None
+    filename = await Repository.s3_save_image(result['image']) if result['image'] else None
 
     await Repository.save_records(
         [
@@ -85,9 +87,6 @@ async def create_product(data: Annotated[ProductPOSTSchema, Depends()], session:
         ]
     )
 
-    if result['image']:
-        await Repository.s3_save_image(result['image'], filename + '.webp')
-
 
 @router_products.get('/refresh')
 async def refresh_product(product_id: int, session: UserSessionModel = Depends(authed)):
@@ -194,11 +193,15 @@ async def create_review(data: Annotated[ReviewCreateSchema, Depends()], files: L
 
     filenames = []
     if files[0].size != 0 or files[0].filename != '':
+        uploads = []
         for file in files:
-            content = await file.read()
-            n, t = await Repository.s3_autosave(content,
-                                                f"{Strings.alphanumeric(32)}.{file.filename.rsplit('.', maxsplit=1)[1]}")
-            filenames.append(f"{n}.{t}")
+            uploads.append((file, file.filename))
+
+        try:
+            for n, t in await Repository.s3_autosave_uploads(uploads):
+                filenames.append(f"{n}.{t}")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
     await ReviewsRepository.create_review(data, filenames)
 
@@ -346,11 +349,15 @@ async def update_review(review_id: int = Form(), files: List[UploadFile] = File(
 
     filenames = []
     if files[0].size != 0 or files[0].filename != '':
+        uploads = []
         for file in files:
-            content = await file.read()
-            n, t = await Repository.s3_autosave(content,
-                                                f"{Strings.alphanumeric(32)}.{file.filename.rsplit('.', maxsplit=1)[1]}")
-            filenames.append(f"{n}.{t}")
+            uploads.append((file, file.filename))
+
+        try:
+            for n, t in await Repository.s3_autosave_uploads(uploads):
+                filenames.append(f"{n}.{t}")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
     if not filenames:
         raise HTTPException(status_code=400, detail='Файлы не выбраны')
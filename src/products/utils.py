@@ -1,11 +1,9 @@
 import json
-from io import BytesIO
 
-import pandas as pd
 import requests
 
 from database import Repository
-from picker.utils import parse_excel_lines
+from picker.utils import read_upload_lines
 from products.models import ProductModel, ReviewModel
 from products.schemas import ProductSizeCreateSchema
 from strings import *
@@ -19,9 +17,7 @@ async def process_reviews_xlsx(file, org_id, stars):
         'text': 3,
     }
 
-    xlsx_reviews_content = await file.read()
-    xlsx_reviews = await parse_excel_lines(pd.read_excel(BytesIO(xlsx_reviews_content), dtype=str).values.tolist(),
-                                           excel_columns)
+    xlsx_reviews = await read_upload_lines(file, excel_columns, False)
 
     if len(xlsx_reviews) <= 6:
         raise Exception('В файле нет отзывов')
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from dotenv import load_dotenv
+
+# the app runs from src, as in the Dockerfile
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.getcwd())
+
+load_dotenv()
+
+# modules build the engine at import, placeholders let tests that need no database import them
+database_configured = (
+    all(os.environ.get(key) for key in ['DB_HOST', 'DB_NAME', 'DB_USER', 'DB_PASS'])
+    and os.environ.get('DB_PORT', '').isdigit()
+)
+
+if not database_configured:
+    os.environ.update({'DB_HOST': 'localhost', 'DB_PORT': '5432', 'DB_NAME': 'test', 'DB_USER': 'test',
+                       'DB_PASS': 'test'})
+
+os.environ.setdefault('HASHSALT', 'test')
+
+import main  # registers every model for mapper configuration
+from database import async_engine
+
+
+def run(coroutine):
+    async def wrapped():
+        try:
+            return await coroutine
+        finally:
+            await async_engine.dispose()
+
+    return asyncio.run(wrapped())
+
+
+@pytest.fixture(scope='session')
+def database():
+    from sqlalchemy import text
+    from database import session_scope
+
+    if not database_configured:
+        pytest.skip('database is not configured, set DB_* variables')
+
+    async def ping():
+        async with session_scope() as session:
+            await session.execute(text('SELECT 1'))
+
+    try:
+        run(ping())
+    except Exception as e:
+        pytest.skip(f'database is not reachable: {e}')
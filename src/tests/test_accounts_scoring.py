@@ -0,0 +1,132 @@
+import collections
+import datetime
+import random
+
+import pytest
+
+from picker.utils import AccountsScoring
+
+
+# the per-account scoring the vectorized AccountsScoring replaced
+def baseline_rank(accs, used_addrs, settings):
+    accs = [acc for acc in accs if acc['contractor']['load_l_min'] <= used_addrs.count(acc['address_id']) + acc['W']
+            <= acc['contractor']['load_l_max']]
+
+    for acc in accs:
+        acc['K'] = used_addrs.count(acc['address_id'])
+        acc['L'] = acc['K'] + acc['W']
+
+    if not accs:
+        return accs
+
+    maxH = max(acc['H'] for acc in accs)
+    maxH = 100 if maxH == 0 else maxH
+
+    for acc in accs:
+        acc['X'] = ((maxH - acc['H']) / maxH) * 100
+        acc['AB'] = acc['L']
+        acc['AD'] = settings['r4'] - acc['T']
+
+        if acc['M'] is not None:
+            if acc['H'] == 0:
+                acc['Z'] = settings['r2']
+            else:
+                t = (datetime.datetime.now().date() - acc['M']).days
+                acc['Z'] = settings['r2'] + t * settings['r3'] if t > settings['r2'] else t
+        else:
+            acc['Z'] = settings['r2'] + 10
+
+        if acc['L'] == 0:
+            acc['AB'] = 0
+        elif acc['L'] >= settings['r4']:
+            acc['AB'] = settings['r4'] - 1
+
+        if acc['T'] == 0:
+            acc['AD'] = 0
+
+    maxX = max(acc['X'] for acc in accs)
+    maxZ = max(acc['Z'] for acc in accs)
+
+    if not all(acc['M'] for acc in accs):
+        maxZ = settings['r2'] + 10
+
+    maxX = 100 if maxX == 0 else maxX
+    maxZ = 100 if maxZ == 0 else maxZ
+
+    for acc in accs:
+        acc['Y'] = (acc['X'] / maxX) * 100
+        acc['AA'] = (acc['Z'] / maxZ) * 100
+        acc['AC'] = (acc['AB'] / (settings['r4'] - 1)) * 100
+        acc['AE'] = acc['AD'] / settings['r4'] * 100
+
+    maxima = {key: max(acc[key] for acc in accs) for key in ['Y', 'AA', 'AC', 'AE']}
+
+    for acc in accs:
+        acc['AF'] = (
+                (acc['Y'] * settings['l2'] + acc['AA'] * settings['l3'] + acc['AC'] * settings['l4'] +
+                 acc['AE'] * settings['l5']) * 100 /
+                (maxima['Y'] * settings['l2'] + maxima['AA'] * settings['l3'] + maxima['AC'] * settings['l4'] +
+                 maxima['AE'] * settings['l5'])
+        )
+
+    return sorted(accs, key=lambda acc: acc['AF'], reverse=True)
+
+
+def fixture(seed):
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+
+    settings = {
+        'r2': rnd.choice([5.0, 10.0, 30.0, 10]),
+        'r3': rnd.choice([0.5, 1.0, 2.0, 1]),
+        'r4': rnd.choice([3.0, 5.0, 8.0, 5]),
+        'l2': rnd.random(), 'l3': rnd.random(), 'l4': rnd.random(), 'l5': rnd.random(),
+    }
+    contractors = [{'load_l_min': rnd.randint(0, 2), 'load_l_max': rnd.randint(3, 12)} for _ in range(3)]
+    addresses = list(range(rnd.randint(1, 15)))
+
+    accs = [
+        {
+            'account_id': account_id,
+            'address_id': rnd.choice(addresses),
+            'W': rnd.randint(0, 5),
+            'T': rnd.randint(0, 3),
+            'H': rnd.choice([0, 0, 1, 2, 5]),
+            'M': None if rnd.random() < 0.3 else today - datetime.timedelta(days=rnd.randint(0, 60)),
+            'contractor': rnd.choice(contractors),
+        }
+        for account_id in range(rnd.randint(1, 60))
+    ]
+    used = [rnd.choice(addresses) for _ in range(rnd.randint(0, 10))]
+
+    return rnd, settings, accs, used
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_scoring_selects_and_logs_as_baseline(seed):
+    rnd, settings, accs, used = fixture(seed)
+
+    baseline_used, expected = list(used), accs
+    scoring = AccountsScoring([dict(acc) for acc in accs], collections.Counter(used), settings)
+
+    for _ in range(rnd.randint(1, 20)):
+        # accounts dropped by L stay dropped, as in the baseline picker
+        expected = baseline_rank([dict(acc) for acc in expected], baseline_used, settings)
+        ranked = scoring.rank()
+
+        assert [acc['account_id'] for acc in ranked] == [acc['account_id'] for acc in expected]
+
+        if not expected:
+            break
+
+        expected_by_id = {acc['account_id']: acc for acc in expected}
+        for acc, scores in scoring.ranked_scores():
+            for key, value in scores.items():
+                expected_value = expected_by_id[acc['account_id']][key]
+
+                # logged cells keep the baseline value and type
+                assert value == expected_value and type(value) is type(expected_value), key
+
+        picked = expected[rnd.randrange(len(expected))]['address_id']
+        baseline_used.append(picked)
+        scoring.use_address(picked)
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+from sqlalchemy import select, func
+
+from conftest import run
+from database import Repository, session_scope
+from orgs.models import OrganizationModel
+from payments.models import BalanceHistoryModel, BalanceActionModel, BalanceSnapshotModel
+from payments.repository import balance_amount
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+# the per-row sum /currentBalance and /tasksPay did before the aggregate
+async def history_loop_balance(session, org_id):
+    history = await session.scalars(select(BalanceHistoryModel).where(BalanceHistoryModel.org_id == org_id))
+
+    total = 0
+    for record in history:
+        if record.action_id in [1, 4]:
+            total += record.amount
+        elif record.action_id in [2, 3]:
+            total -= record.amount
+
+    return total
+
+
+async def aggregate_balance(session, org_id):
+    return int(await session.scalar(
+        select(func.coalesce(func.sum(balance_amount), 0)).where(BalanceHistoryModel.org_id == org_id)
+    ))
+
+
+async def snapshot_balance(session, org_id):
+    return await session.scalar(select(BalanceSnapshotModel.amount).where(BalanceSnapshotModel.org_id == org_id))
+
+
+async def timed(coroutine):
+    started = time.perf_counter()
+    value = await coroutine
+    return value, time.perf_counter() - started
+
+
+@pytest.mark.parametrize('rows', [10000, 100000, 1000000])
+def test_balance_paths(rows):
+    async def benchmark():
+        async with session_scope() as session:
+            org_id = await session.scalar(select(OrganizationModel.id).limit(1))
+            action_ids = (await session.scalars(
+                select(BalanceActionModel.id).where(BalanceActionModel.id.in_([1, 2, 3, 4]))
+            )).all()
+
+            if org_id is None or not action_ids:
+                pytest.skip('no organization or balance actions to attach history to')
+
+            # the rows live in this transaction only and are rolled back
+            await Repository.copy_records(BalanceHistoryModel, [
+                {'org_id': org_id, 'action_id': action_ids[i % len(action_ids)], 'amount': i % 100,
+                 'description': 'balance-benchmark'}
+                for i in range(rows)
+            ], session)
+
+            results = {
+                'history loop': await timed(history_loop_balance(session, org_id)),
+                'aggregate': await timed(aggregate_balance(session, org_id)),
+                'snapshot': await timed(snapshot_balance(session, org_id)),
+            }
+
+            await session.rollback()
+
+        return results
+
+    results = run(benchmark())
+
+    print(f'\n{rows} history rows: ' + ', '.join(
+        f'{path} {seconds * 1000:.1f} ms' for path, (_, seconds) in results.items()
+    ))
+    # the snapshot is only as right as the ledger was before the benchmark, /reconcileBalances checks that
+    assert results['aggregate'][0] == results['history loop'][0]
+    assert results['aggregate'][1] < results['history loop'][1]
@@ -0,0 +1,86 @@
+import pytest
+from sqlalchemy import select, func, text, delete
+
+from conftest import run
+from database import Repository, session_scope
+from gutils import Strings
+from orgs.models import OrganizationModel
+from payments.models import BalanceHistoryModel, BalanceActionModel, BalanceSnapshotModel
+from payments.repository import BalanceLedgerRepository
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+async def history_record(description):
+    async with session_scope() as session:
+        org_id = await session.scalar(select(OrganizationModel.id).limit(1))
+        action_id = await session.scalar(select(BalanceActionModel.id).where(BalanceActionModel.id == 1))
+
+    if org_id is None or action_id is None:
+        pytest.skip('no organization or top up action to attach history to')
+
+    return {'org_id': org_id, 'action_id': action_id, 'amount': 1, 'description': description}
+
+
+async def state(record):
+    async with session_scope() as session:
+        count = await session.scalar(
+            select(func.count(BalanceHistoryModel.id)).where(BalanceHistoryModel.description == record['description'])
+        )
+        snapshot = await session.scalar(
+            select(BalanceSnapshotModel.amount).where(BalanceSnapshotModel.org_id == record['org_id'])
+        )
+
+    return count, snapshot
+
+
+async def cleanup(record):
+    async with session_scope() as session:
+        await session.execute(delete(BalanceHistoryModel).where(BalanceHistoryModel.description == record['description']))
+        await BalanceLedgerRepository.rebuild(session, {record['org_id']})
+        await session.commit()
+
+
+def test_copy_is_rolled_back_with_failed_session():
+    async def copy_then_fail():
+        record = await history_record(f'copy-test-{Strings.alphanumeric(16)}')
+        before = await state(record)
+
+        with pytest.raises(Exception):
+            async with session_scope() as session:
+                # the copy is the first statement of the session
+                await Repository.copy_records(BalanceHistoryModel, [record] * 3, session)
+                await session.execute(text('SELECT 1 / 0'))
+                await session.commit()
+
+        return before, await state(record)
+
+    before, after = run(copy_then_fail())
+    assert after == before
+    assert after[0] == 0
+
+
+def test_copy_is_committed_with_ledger():
+    async def copy_then_commit():
+        record = await history_record(f'copy-test-{Strings.alphanumeric(16)}')
+        await cleanup(record)
+        before = await state(record)
+
+        try:
+            async with session_scope() as session:
+                await Repository.copy_records(BalanceHistoryModel, [record] * 3, session)
+                await session.rollback()
+
+            rolled_back = await state(record)
+
+            await Repository.copy_records(BalanceHistoryModel, [record] * 3)
+            committed = await state(record)
+
+        finally:
+            await cleanup(record)
+
+        return before, rolled_back, committed
+
+    before, rolled_back, committed = run(copy_then_commit())
+    assert rolled_back == before
+    assert committed == (3, before[1] + 3)
@@ -0,0 +1,92 @@
+import asyncio
+import io
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import database
+from config import IMAGE_MAX_WIDTH, IMAGE_MAX_HEIGHT, IMAGE_RENDITIONS
+
+IMAGES = 3
+
+
+def photo(seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (1500, 2000, 3), dtype=np.uint8)
+
+    content = io.BytesIO()
+    Image.fromarray(pixels).save(content, format='JPEG', quality=90)
+    return content.getvalue()
+
+
+# the conversion s3_autosave did on the event loop before image_to_webp, a discarded encode and the kept one
+async def loop_to_webp(file_bytes):
+    image = Image.open(io.BytesIO(file_bytes))
+    image.save(io.BytesIO(), format='WEBP', optimize=True, quality=15)
+
+    webp_bytes = io.BytesIO()
+    image.save(webp_bytes, format='WebP')
+    return webp_bytes.getvalue()
+
+
+async def pool_to_webp(file_bytes):
+    return await database.image_to_webp(file_bytes, {None: (IMAGE_MAX_WIDTH, IMAGE_MAX_HEIGHT), **IMAGE_RENDITIONS})
+
+
+async def measure(convert, images):
+    # a ticker that should wake every millisecond, its longest gap is how long the loop was blocked
+    stalls = []
+
+    async def tick():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - started)
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(0.01)
+
+    latencies = []
+    for file_bytes in images:
+        started = time.perf_counter()
+        await convert(file_bytes)
+        latencies.append(time.perf_counter() - started)
+
+        # lets the ticker wake up and record the gap
+        await asyncio.sleep(0.01)
+
+    ticker.cancel()
+    return sum(latencies) / len(latencies), max(stalls)
+
+
+@pytest.fixture
+def image_pool():
+    yield
+
+    if database.image_pool is not None:
+        database.image_pool.shutdown()
+        database.image_pool = None
+
+
+@pytest.mark.usefixtures('image_pool')
+def test_pool_conversion_keeps_the_loop_responsive():
+    images = [photo(seed) for seed in range(IMAGES)]
+
+    async def benchmark():
+        # the first call starts the workers
+        await pool_to_webp(images[0])
+
+        return {
+            'loop': await measure(loop_to_webp, images),
+            'pool': await measure(pool_to_webp, images),
+        }
+
+    results = asyncio.run(benchmark())
+
+    print('\n' + ', '.join(
+        f'{path}: {latency * 1000:.0f} ms per image, loop blocked up to {stall * 1000:.0f} ms'
+        for path, (latency, stall) in results.items()
+    ))
+    assert results['pool'][0] < results['loop'][0]
+    assert results['pool'][1] < 0.1 < results['loop'][1]
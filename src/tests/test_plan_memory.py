@@ -0,0 +1,134 @@
+import collections
+import datetime
+import gc
+import os
+import random
+import resource
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from sqlalchemy import select, func, delete
+
+from conftest import run
+from database import Repository, session_scope
+from picker import utils
+from picker.models import PickerServerModel, PickerHistoryModel
+
+WARMUP_RUNS = 10
+RUNS = 50
+MB = 1024 * 1024
+
+
+def rss():
+    if not os.path.exists('/proc/self/statm'):
+        pytest.skip('resident size is read from /proc')
+
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def assert_flat(run_once, limit):
+    # allocator pools settle during the warmup, a run that keeps its sheets grows the process by ~50kB each.
+    # cycles are collected after every run, freed memory is not given back to the system
+    for _ in range(WARMUP_RUNS):
+        run_once()
+        gc.collect()
+
+    warmed_up = rss()
+
+    for _ in range(RUNS):
+        run_once()
+        gc.collect()
+
+    assert rss() - warmed_up < limit
+
+
+def synthetic_plan(seed):
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+
+    contractors = [SimpleNamespace(id=i, name=f'contractor {i}') for i in range(3)]
+    server = SimpleNamespace(
+        schedule=SimpleNamespace(time_min_min_per_step=0, time_max_min_per_step=2, time_start=datetime.time(8),
+                                 time_end=datetime.time(20), time_first_point=datetime.time(21),
+                                 time_second_point=datetime.time(22)),
+        contractors=[
+            SimpleNamespace(contractor=contractor, load_percent=1 / 3, load_j_min=0, load_j_max=3, load_l_min=0,
+                            load_l_max=50, load_t_min=0, load_t_max=5, load_i=100, load_m=today)
+            for contractor in contractors
+        ],
+    )
+    addresses = [
+        SimpleNamespace(id=i, address=f'address {i}', district='district', contractor=None, contractor_id=i % 3,
+                        is_active=True)
+        for i in range(20)
+    ]
+    accounts = [
+        SimpleNamespace(id=i, number=f'7900{i:07d}', name='name', is_active=True, reg_date=None, address_id=i % 20,
+                        address=addresses[i % 20])
+        for i in range(60)
+    ]
+    orgs = [SimpleNamespace(title=f'org {i}') for i in range(3)]
+    tasks = [
+        SimpleNamespace(id=i, ozon_keyword='keyword', product=SimpleNamespace(
+            ozon_article=rnd.randint(1, 20), ozon_size=None, ozon_price=100, organization=rnd.choice(orgs)))
+        for i in range(30)
+    ]
+    settings = SimpleNamespace(r2=10.0, r3=1.0, r4=5.0, l2=1.0, l3=1.0, l4=1.0, l5=1.0, lo=30, al=365,
+                               k_format='%H:%M')
+    orders = pd.DataFrame([
+        {'account_id': i % 60, 'address_id': i % 20, 'org_id': i % 3, 'org': f'org {i % 3}', 'dt_ordered': today,
+         'dt_delivered': None, 'dt_collected': None}
+        for i in range(400)
+    ])
+
+    return (utils.plan_server(server), utils.plan_tasks(tasks), utils.plan_accounts(accounts), {}, {},
+            utils.OrdersAggregates(orders), utils.plan_settings(settings), [])
+
+
+def test_server_plans_keep_resident_size_flat():
+    plan = synthetic_plan(0)
+
+    def run_once():
+        result_path, logs_path, _, _ = utils.pick_server_accounts(*plan, collections.Counter(), {})
+
+        for path in (result_path, logs_path):
+            if path is not None:
+                os.remove(path)
+
+    assert_flat(run_once, 1 * MB)
+
+
+@pytest.mark.usefixtures('database')
+def test_generate_plan_main_keeps_resident_size_flat(monkeypatch):
+    async def discard_file(path, file_name):
+        pass
+
+    # runs produce real plans, only the upload is left out
+    monkeypatch.setattr(Repository, 's3_save_file', discard_file)
+
+    async def last_history_id():
+        async with session_scope() as session:
+            return await session.scalar(select(func.max(PickerHistoryModel.id))) or 0
+
+    servers = run(Repository.get_records(
+        PickerServerModel,
+        filters=[PickerServerModel.is_active],
+        select_related=[PickerServerModel.contractors, PickerServerModel.schedule]
+    ))
+
+    if not servers:
+        pytest.skip('no active servers to plan')
+
+    history_id = run(last_history_id())
+
+    async def cleanup():
+        async with session_scope() as session:
+            await session.execute(delete(PickerHistoryModel).where(PickerHistoryModel.id > history_id))
+            await session.commit()
+
+    try:
+        assert_flat(lambda: run(utils.generate_plan_main(servers, '', datetime.date.today())), 8 * MB)
+    finally:
+        run(cleanup())
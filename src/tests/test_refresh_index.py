@@ -0,0 +1,73 @@
+import gc
+import time
+from types import SimpleNamespace
+
+from picker.utils import RefreshIndex
+
+
+def synthetic_refresh(size):
+    product = SimpleNamespace(org_id=1)
+    success = SimpleNamespace(is_success=True)
+
+    accounts = [SimpleNamespace(id=i, number=f'7900{i:07d}') for i in range(size // 10)]
+    addresses = [SimpleNamespace(id=i, address=f'address {i}') for i in range(size // 10)]
+    orders = [
+        SimpleNamespace(id=i, ozon_price=100, status=1, product_id=1, product=product, ozon_uuid=f'uuid-{i}',
+                        dt_collected=None, picker_status=success)
+        for i in range(size)
+    ]
+
+    # every order shows up in the files, half of them only by plan sid
+    lines = [
+        {'uuid': f'uuid-{i}' if i % 2 else f'plan-{i}', 'account_number': f'7900{i % (size // 10):07d}',
+         'address': f'address {i % (size // 10)}'}
+        for i in range(size)
+    ]
+    plan_uuids = {f'plan-{i}': {'sid': str(i)} for i in range(0, size, 2)}
+
+    return accounts, addresses, orders, lines, plan_uuids
+
+
+def refresh_lookups(accounts, addresses, orders, lines, plan_uuids):
+    index = RefreshIndex(accounts, addresses, orders)
+    found = 0
+
+    for line in lines:
+        order = index.uuids.get(line['uuid'])
+
+        if not order and line['uuid'] in plan_uuids:
+            order = index.order(plan_uuids[line['uuid']]['sid'])
+
+        account_id = index.accounts.get(line['account_number'])
+        address_id = index.addresses.get(line['address'])
+
+        if order and account_id is not None and address_id is not None:
+            found += 1
+
+    return found
+
+
+def timed(size, repeat=3):
+    data = synthetic_refresh(size)
+    best = None
+
+    for _ in range(repeat):
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            assert refresh_lookups(*data) == size
+            elapsed = time.perf_counter() - started
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def test_refresh_lookups_scale_linearly_up_to_200k_orders():
+    small = timed(50000)
+    large = timed(200000)
+
+    # 4x the orders and lines, a per-line scan of the orders would take ~16x
+    print(f'\nrefresh lookups: 50k orders {small:.3f}s, 200k orders {large:.3f}s, ratio {large / small:.1f}')
+    assert large / small < 10
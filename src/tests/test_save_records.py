@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy import select, func
+
+from conftest import run
+from database import Repository, session_scope
+from orders.models import OrdersContractorModel
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+def test_save_records_upserts_by_id():
+    async def saved(record_id):
+        records = await Repository.get_records(OrdersContractorModel, filters=[OrdersContractorModel.id == record_id])
+        return [(record.name, record.is_active) for record in records]
+
+    async def upsert():
+        async with session_scope() as session:
+            record_id = (await session.scalar(select(func.max(OrdersContractorModel.id))) or 0) + 1000
+
+        try:
+            # an unknown id is inserted with that id, a known one is updated
+            await Repository.save_records([{'model': OrdersContractorModel, 'records': [
+                {'id': record_id, 'name': 'upsert-test', 'is_active': False},
+            ]}])
+            inserted = await saved(record_id)
+
+            await Repository.save_records([{'model': OrdersContractorModel, 'records': [
+                {'id': record_id, 'name': 'upsert-test-updated'},
+            ]}])
+            updated = await saved(record_id)
+
+        finally:
+            await Repository.delete_record(OrdersContractorModel, record_id)
+
+        return inserted, updated
+
+    inserted, updated = run(upsert())
+    assert inserted == [('upsert-test', False)]
+    assert updated == [('upsert-test-updated', False)]
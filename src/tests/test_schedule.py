@@ -0,0 +1,204 @@
+import copy
+import datetime
+import io
+import os
+import random
+import time
+
+import openpyxl
+import pytest
+
+from picker.utils import Result
+
+
+# the row scanning schedule the indexed Result.schedule replaced, on an openpyxl sheet
+def baseline_schedule(sheet, date, server, orgs, arts, k_format):
+
+    class ScheduleCell:
+
+        def __init__(self, dt):
+            self.dt = dt
+            self.org = None
+
+    def calc_cells(dts, dte, osd):
+        return int((dte - dts).total_seconds() / osd.total_seconds())
+
+    tasks_amount = sum(orgs.values())
+
+    max_one_step_duration = server['schedule']['time_max_min_per_step']
+    min_one_step_duration = server['schedule']['time_min_min_per_step']
+
+    start_time = datetime.datetime.combine(date, server['schedule']['time_start'])
+    end_time = datetime.datetime.combine(date, server['schedule']['time_end'])
+
+    middle_point = datetime.datetime.combine(date, server['schedule']['time_first_point'])
+    last_point = datetime.datetime.combine(date, server['schedule']['time_second_point'])
+
+    one_step_duration = datetime.timedelta(minutes=max_one_step_duration)
+    cells_amount = calc_cells(start_time, end_time, one_step_duration)
+
+    if cells_amount < tasks_amount:
+        end_time = middle_point
+        cells_amount = calc_cells(start_time, end_time, one_step_duration)
+
+        if cells_amount < tasks_amount:
+            one_step_duration = datetime.timedelta(minutes=(cells_amount / tasks_amount) * max_one_step_duration)
+            one_step_duration = one_step_duration - datetime.timedelta(microseconds=one_step_duration.microseconds)
+
+            if one_step_duration < datetime.timedelta(minutes=min_one_step_duration):
+                one_step_duration = datetime.timedelta(minutes=max_one_step_duration)
+                end_time = last_point
+                cells_amount = calc_cells(start_time, end_time, one_step_duration)
+
+                if cells_amount < tasks_amount:
+                    one_step_duration = datetime.timedelta(
+                        minutes=(cells_amount / tasks_amount) * max_one_step_duration)
+                    one_step_duration = one_step_duration - datetime.timedelta(
+                        microseconds=one_step_duration.microseconds)
+
+                    if one_step_duration < datetime.timedelta(minutes=min_one_step_duration):
+                        raise Exception('Недостаточно ячеек для расписания')
+
+    schedule = []
+    current_time = start_time
+    while current_time < end_time:
+        schedule.append(ScheduleCell(current_time))
+        current_time += one_step_duration
+
+    if schedule[-1].dt > end_time - one_step_duration:
+        schedule = schedule[:-1]
+
+    time_length = (end_time - start_time).total_seconds()
+
+    for org in orgs:
+        amount = orgs[org]
+        single_length = time_length / amount
+
+        for x in range(amount):
+            dt = start_time + datetime.timedelta(seconds=x * single_length)
+
+            for cell in schedule:
+                if cell.dt >= dt and not cell.org:
+                    cell.org = org
+                    break
+
+    used_dt = []
+    used_lines = []
+
+    for org in arts:
+        for i in range(max(arts[org].values())):
+            for art in arts[org]:
+                if arts[org][art] != 0:
+                    line = 1
+                    for row in sheet.rows:
+                        if str(row[1].value) == str(art) and str(row[13].value) == str(org) and line not in used_lines:
+                            for cell in schedule:
+                                if cell.org and cell.org == org and cell.dt not in used_dt:
+                                    used_dt.append(cell.dt)
+                                    row[10].value = cell.dt.strftime(k_format)
+                                    break
+                            used_lines.append(line)
+                            break
+                        line += 1
+                    arts[org][art] -= 1
+
+
+def fixture(seed, tasks_amount=None):
+    rnd = random.Random(seed)
+    orgs = [f'org{i}' for i in range(rnd.randint(1, 8))]
+
+    tasks = [
+        {'id': task_id, 'keyword': 'kw', 'article': rnd.choice([1, 2, 3, '4', 5]), 'size': None, 'price': 10,
+         'org': rnd.choice(orgs)}
+        for task_id in range(tasks_amount or rnd.randint(1, 150))
+    ]
+    server = {
+        'schedule': {
+            'time_max_min_per_step': rnd.randint(1, 10),
+            'time_min_min_per_step': rnd.randint(0, 2),
+            'time_start': datetime.time(8),
+            'time_end': datetime.time(rnd.randint(9, 12)),
+            'time_first_point': datetime.time(rnd.randint(12, 16)),
+            'time_second_point': datetime.time(rnd.randint(16, 23)),
+        }
+    }
+
+    orgs_amounts, arts = {}, {}
+    for task in tasks:
+        orgs_amounts[task['org']] = orgs_amounts.get(task['org'], 0) + 1
+        arts.setdefault(task['org'], {})[task['article']] = arts.get(task['org'], {}).get(task['article'], 0) + 1
+
+    return tasks, server, orgs_amounts, arts
+
+
+def baseline_rows(tasks, server, orgs, arts, date, k_format):
+    written = Result('baseline', date)
+    book = openpyxl.Workbook()
+
+    try:
+        written.tasks(tasks)
+        for row, values in written.active.rows.items():
+            for column, value in values.items():
+                book.active.cell(row=row, column=column, value=value)
+    finally:
+        written.close()
+
+    baseline_schedule(book.active, date, server, orgs, arts, k_format)
+    return saved_rows(book)
+
+
+def result_rows(tasks, server, orgs, arts, date, k_format):
+    result = Result('result', date)
+    try:
+        result.tasks(tasks)
+        result.schedule(server, orgs, arts, k_format)
+        path = result.save()
+    finally:
+        result.close()
+
+    try:
+        return saved_rows(openpyxl.load_workbook(path))
+    finally:
+        os.remove(path)
+
+
+def saved_rows(book):
+    content = io.BytesIO()
+    book.save(content)
+    content.seek(0)
+
+    rows = [list(row) for row in openpyxl.load_workbook(content).active.iter_rows(values_only=True)]
+    width = max(len(row) for row in rows)
+    return [row + [None] * (width - len(row)) for row in rows]
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_schedule_output_matches_baseline(seed):
+    tasks, server, orgs, arts = fixture(seed)
+    date = datetime.datetime(2024, 5, 1)
+
+    try:
+        expected = baseline_rows(tasks, server, orgs, copy.deepcopy(arts), date, '%H:%M:%S')
+    except Exception as e:
+        with pytest.raises(Exception, match=str(e)):
+            result_rows(tasks, server, orgs, copy.deepcopy(arts), date, '%H:%M:%S')
+        return
+
+    assert result_rows(tasks, server, orgs, copy.deepcopy(arts), date, '%H:%M:%S') == expected
+
+
+def test_schedule_of_thousands_of_tasks_takes_milliseconds():
+    tasks, server, orgs, arts = fixture(0, tasks_amount=3000)
+    server['schedule'].update(time_max_min_per_step=1, time_min_min_per_step=0, time_end=datetime.time(23))
+
+    result = Result('result', datetime.datetime(2024, 5, 1))
+    try:
+        result.tasks(tasks)
+
+        started = time.perf_counter()
+        result.schedule(server, orgs, arts, '%H:%M:%S')
+        elapsed = time.perf_counter() - started
+    finally:
+        result.close()
+
+    assert elapsed < 0.5